@@ -1,3 +1,20 @@
+from middleware.startup import startup_timer
+
+# Imported one at a time for the startup report, in dependency order
+for module in [
+    "flet",
+    "middleware.sqlite_handler",
+    "middleware.settings",
+    "middleware.features",
+    "middleware.llm_handler",
+    "middleware.yt_api",
+    "middleware.ingest_pipeline",
+    "ui.video_grid",
+    "ui.config_page",
+    "ui.main_page",
+]:
+    startup_timer.import_module(module)
+
 import flet as ft
 
 from ui.main_page import MainPage
@@ -21,14 +38,17 @@ async def main(page: ft.Page):
     )
 
     # Add the main page to the application
-    main_page = MainPage(page)
+    with startup_timer.step("MainPage()"):
+        main_page = MainPage(page)
     page.on_resized = main_page.on_resized
-    page.add(main_page)
-    page.update()
+    with startup_timer.step("first frame"):
+        page.add(main_page)
+        page.update()
 
     # Does a bit of a weird thing where I need to send a manual
     # resize event to get things to start in the right spots
     page.on_resized(e)
+    startup_timer.report()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,50 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from middleware.sqlite_handler import DBHandler
+
+
+class AsyncDBHandler:
+    # Awaitable version of DBHandler. Every call runs on one dedicated thread
+    # using the background writer connection, so queries never block the event
+    # loop and still run one at a time in the order they were awaited.
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        self.db_handler = DBHandler(background=True)
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    def __getattr__(self, name):
+        method = getattr(self.db_handler, name)
+
+        async def call(*args, **kwargs):
+            return await self.run(method, *args, **kwargs)
+
+        return call
+
+    async def iter_full_video_data(self, batch_size=100):
+        # Streams the videos table a batch at a time, other queries can run on
+        # the db thread in between batches
+        batches = self.db_handler.iter_full_video_data(batch_size)
+        try:
+            while True:
+                batch = await self.run(next, batches, None)
+                if batch is None:
+                    break
+                yield batch
+        finally:
+            await self.run(batches.close)
+
+
+_async_db_handler = None
+
+
+def async_db_handler():
+    # Shared instance, created on first use so nothing touches the db at import
+    global _async_db_handler
+    if _async_db_handler is None:
+        _async_db_handler = AsyncDBHandler()
+    return _async_db_handler
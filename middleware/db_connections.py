@@ -0,0 +1,66 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Applied to every connection. WAL lets readers keep going while a writer commits,
+# NORMAL sync is safe under WAL and skips most of the fsyncs.
+CONNECTION_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    # Negative means KiB, so 64 MB of page cache per connection
+    "PRAGMA cache_size = -65536",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+]
+
+
+class ConnectionManager:
+    # Hands out long lived connections instead of opening a new one for every
+    # DBHandler. The UI shares one connection on the event loop, background jobs
+    # get their own writer and threads borrow from a small pool of readers.
+    def __init__(self, db_file, readers=4, busy_timeout=30):
+        self.db_file = db_file
+        self.busy_timeout = busy_timeout
+        self.lock = threading.Lock()
+        self.main = None
+        self.background = None
+        self.readers = queue.LifoQueue()
+        self.reader_slots = threading.BoundedSemaphore(readers)
+        self.initialized = False
+
+    def connect(self):
+        conn = sqlite3.connect(
+            self.db_file, timeout=self.busy_timeout, check_same_thread=False
+        )
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def main_connection(self):
+        with self.lock:
+            if self.main is None:
+                self.main = self.connect()
+            return self.main
+
+    def background_connection(self):
+        with self.lock:
+            if self.background is None:
+                self.background = self.connect()
+            return self.background
+
+    @contextmanager
+    def reader(self):
+        # Blocks while every reader is borrowed
+        with self.reader_slots:
+            try:
+                conn = self.readers.get_nowait()
+            except queue.Empty:
+                conn = self.connect()
+                conn.execute("PRAGMA query_only = ON")
+            try:
+                yield conn
+            finally:
+                # Never hand the next borrower an open read transaction
+                conn.rollback()
+                self.readers.put(conn)
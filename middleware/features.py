@@ -0,0 +1,300 @@
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import string
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from middleware.settings import app_settings
+
+# The regex tokenizer only keeps the word_tokenize rules that can still leave an
+# alphanumeric token behind, punctuation that word_tokenize always splits off is
+# simply turned into whitespace. Patterns are copied from nltk's NLTKWordTokenizer
+# and run in the same order, some punctuation is split before the apostrophe
+# rules and some after.
+EARLY_SEPARATORS = re.compile(r"\.{2,}|[«“‘„`;@#$%&\u2012-\u2015?!]")
+LATE_SEPARATORS = re.compile(r"--|''|[*()\[\]{}<>»”’\"]")
+# Only the end of the transcript needs these, that's where the last period splits
+STARTING_QUOTES = [
+    (re.compile("([«“‘„]|[`]+)"), r" \1 "),
+    (re.compile(r"^\""), r"``"),
+    (re.compile(r"(``)"), r" \1 "),
+    (re.compile(r"([ \(\[{<])(\"|\'{2})"), r"\1 `` "),
+]
+FINAL_PERIOD = re.compile(r"([^\.])(\.)([\]\)}>\"\'»”’ ]*)\s*$")
+TAIL_CHARS = 200
+# Batches smaller than this are extracted in a thread, sending them to the
+# worker processes costs more than it saves
+MIN_POOL_TRANSCRIPTS = 16
+STARTING_APOSTROPHE = re.compile(r"(?<!\w)(\')(?!(?:re|ve|ll|m|t|s|d|n)\b)(?=\w)")
+COMMA_COLON = re.compile(r"([:,])([^\d]|$)")
+TRAILING_APOSTROPHE = re.compile(r"([^'])' ")
+# A word can lose more than one clitic, so these stay separate passes
+CLITICS = [
+    re.compile(r"([^'\s])('s|'m|'d|')(?=\s)"),
+    re.compile(r"([^'\s])('ll|'re|'ve|n't)(?=\s)"),
+]
+CONTRACTIONS = [
+    re.compile(r"\b(cannot|d'ye|gimme|gonna|gotta|lemme|more'n)\b|\b(wanna)(?=\s)"),
+    re.compile(r"\s('tis)\b"),
+    re.compile(r"\s('twas)\b"),
+]
+CONTRACTION_SPLITS = {
+    "cannot": " can not ",
+    "d'ye": " d 'ye ",
+    "gimme": " gim me ",
+    "gonna": " gon na ",
+    "gotta": " got ta ",
+    "lemme": " lem me ",
+    "more'n": " more 'n ",
+    "wanna": " wan na ",
+    "'tis": " 't is ",
+    "'twas": " 't was ",
+}
+
+
+_nltk_loaded = False
+
+
+def load_nltk(download=True):
+    # nltk is slow to import and may have to download its data, so it's only
+    # loaded once features are first needed rather than at startup. Worker
+    # processes skip the download, the app has fetched the data before
+    # starting them.
+    global _nltk_loaded
+    if _nltk_loaded:
+        return
+    import nltk
+
+    nltk.data.path.append("./nltk_data")
+    if download:
+        # Ensure nltk resources are downloaded
+        nltk.download("punkt_tab", download_dir="./nltk_data/", quiet=True)
+        nltk.download("stopwords", download_dir="./nltk_data/", quiet=True)
+    _nltk_loaded = True
+
+
+def split_contraction(match):
+    return CONTRACTION_SPLITS[match.group(match.lastindex)]
+
+
+def regex_word_tokenize(text):
+    # Same alphanumeric tokens as word_tokenize(text, preserve_line=True) for
+    # lowercase text, other tokens may be missing. Plain words need no special
+    # handling, so it gets by with half the regex passes of word_tokenize.
+    cut = max(text.rfind(" ", 0, max(len(text) - TAIL_CHARS, 0)), 0)
+    tail = text[cut:]
+    for regex, substitution in STARTING_QUOTES:
+        tail = regex.sub(substitution, tail)
+    tail = FINAL_PERIOD.sub(r"\1 \2 \3 ", tail)
+
+    text = EARLY_SEPARATORS.sub(" ", text[:cut] + tail)
+    text = STARTING_APOSTROPHE.sub(r"\1 ", text)
+    text = COMMA_COLON.sub(r" \1 \2", text)
+    text = TRAILING_APOSTROPHE.sub(r"\1 ' ", text)
+    text = LATE_SEPARATORS.sub(" ", f" {text} ")
+    for regex in CLITICS:
+        text = regex.sub(r"\1 \2 ", text)
+    for regex in CONTRACTIONS:
+        text = regex.sub(split_contraction, text)
+    return text.split()
+
+
+def nltk_word_tokenize(text):
+    load_nltk()
+    from nltk.tokenize import word_tokenize
+
+    return word_tokenize(text, preserve_line=True)
+
+
+# Backends for the ollama_tokenizer setting
+tokenizers = {"regex": regex_word_tokenize, "nltk": nltk_word_tokenize}
+
+
+def transcript_hash(transcript):
+    return hashlib.sha256((transcript or "").encode()).hexdigest()
+
+
+def feature_sizes(transcript):
+    # Number of top words and grams, and the gram length, for a transcript
+    gram_len = 3 if len(transcript or "") <= 10000 else 4
+    return 25, gram_len
+
+
+class FeatureExtractor:
+    # Pulls the most frequent words and n-grams out of a transcript. The stop
+    # word set is built once and only rebuilt when the custom stop words change.
+    def __init__(self, custom_stop_words, tokenizer, download=True):
+        load_nltk(download)
+        from nltk.corpus import stopwords
+
+        self.base_stop_words = set(stopwords.words("english"))
+        # Add all the single letters
+        self.base_stop_words.update(string.ascii_lowercase)
+        self.stop_words = None
+        self.stop_words_hash = None
+        self.build_stop_words(custom_stop_words)
+        self.word_tokenize = None
+        self.set_tokenizer(tokenizer)
+
+    def build_stop_words(self, custom_stop_words):
+        self.stop_words = frozenset(self.base_stop_words.union(custom_stop_words))
+        self.stop_words_hash = hashlib.sha256(
+            json.dumps(sorted(self.stop_words)).encode()
+        ).hexdigest()
+
+    def set_tokenizer(self, backend):
+        self.word_tokenize = tokenizers[backend]
+
+    def on_setting_changed(self, name, value):
+        if name == "ollama_custom_stop_words":
+            self.build_stop_words(value)
+        elif name == "ollama_tokenizer":
+            self.set_tokenizer(value)
+
+    def tokenize(self, text):
+        # lowercase for normalization
+        words = self.word_tokenize(text.lower())
+        stop_words = self.stop_words
+        # Remove stop words
+        return [word for word in words if word.isalnum() and word not in stop_words]
+
+    def extract(self, text, max_words=10, gram_len=3):
+        if text is None:
+            return [], []
+
+        filtered_words = self.tokenize(text)
+
+        # Same tuples as nltk's ngrams without the generator overhead
+        grams = zip(*(filtered_words[i:] for i in range(gram_len)))
+
+        # Get frequency distribution, Counter gives the same order as nltk's FreqDist
+        word_freq = Counter(filtered_words)
+        gram_freq = Counter(grams)
+
+        # Display the most common words
+        top_words = word_freq.most_common(max_words)
+        top_grams = gram_freq.most_common(max_words)
+
+        # Filter out results that only appear a single time
+        # Drop out some of the result, more so on words than grams
+        top_words = [word for word, freq in top_words if freq >= 1]
+        top_grams = [" ".join(gram) for gram, freq in top_grams if freq >= 1]
+
+        return top_words, top_grams
+
+    def extract_batch(self, texts, max_words=10, gram_len=3):
+        return [self.extract(text, max_words, gram_len) for text in texts]
+
+    def cache_key(self, transcript):
+        # Stored features are only valid for the same transcript, stop words and sizes
+        max_words, gram_len = feature_sizes(transcript)
+        settings_hash = f"{self.stop_words_hash}:{max_words}:{gram_len}"
+        return transcript_hash(transcript), settings_hash
+
+    def transcript_features(self, transcript):
+        # (transcript_hash, settings_hash, top_words, top_grams), as stored in the db
+        top_words, top_grams = self.extract(transcript, *feature_sizes(transcript))
+        return *self.cache_key(transcript), top_words, top_grams
+
+
+_feature_extractor = None
+_feature_extractor_lock = threading.Lock()
+
+
+def feature_extractor():
+    # Shared instance, built on first use. That loads nltk, so callers on the
+    # event loop should get it from a thread.
+    global _feature_extractor
+    with _feature_extractor_lock:
+        if _feature_extractor is None:
+            _feature_extractor = FeatureExtractor(
+                app_settings["ollama_custom_stop_words"],
+                app_settings["ollama_tokenizer"],
+            )
+            app_settings.subscribe(_feature_extractor.on_setting_changed)
+    return _feature_extractor
+
+
+# Each worker process has its own extractor, set up from the settings it was
+# started with instead of reading them from the db
+_worker_extractor = None
+
+
+def init_worker(custom_stop_words, tokenizer):
+    global _worker_extractor
+    _worker_extractor = FeatureExtractor(custom_stop_words, tokenizer, download=False)
+
+
+def worker_transcript_features(transcripts):
+    return [_worker_extractor.transcript_features(t) for t in transcripts]
+
+
+class FeaturePool:
+    # Extracts features for many transcripts at once, spread over worker
+    # processes on every core so tokenizing doesn't hold up the event loop or
+    # the LLM requests. The workers are restarted when the extractor settings
+    # change.
+    def __init__(self):
+        self.workers = os.cpu_count() or 1
+        self.executor = None
+        self.worker_settings = None
+
+    def get_executor(self):
+        worker_settings = (
+            app_settings["ollama_custom_stop_words"],
+            app_settings["ollama_tokenizer"],
+        )
+        if worker_settings != self.worker_settings:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+            # Spawned rather than forked, the app has threads running
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker,
+                initargs=worker_settings,
+            )
+            self.worker_settings = worker_settings
+        return self.executor
+
+    async def transcript_features(self, transcripts):
+        # Same as feature_extractor().transcript_features for each transcript
+        if len(transcripts) < MIN_POOL_TRANSCRIPTS:
+            return await asyncio.to_thread(
+                lambda: [
+                    feature_extractor().transcript_features(t) for t in transcripts
+                ]
+            )
+
+        # The workers don't download the nltk data themselves
+        await asyncio.to_thread(feature_extractor)
+        executor = self.get_executor()
+        loop = asyncio.get_running_loop()
+        chunk_size = -(-len(transcripts) // self.workers)
+        chunks = await asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    executor,
+                    worker_transcript_features,
+                    transcripts[i : i + chunk_size],
+                )
+                for i in range(0, len(transcripts), chunk_size)
+            )
+        )
+        return [features for chunk in chunks for features in chunk]
+
+
+_feature_pool = None
+
+
+def feature_pool():
+    # Shared instance, workers are only started on first use
+    global _feature_pool
+    if _feature_pool is None:
+        _feature_pool = FeaturePool()
+    return _feature_pool
@@ -0,0 +1,292 @@
+import asyncio
+
+from middleware.features import feature_extractor
+from middleware.yt_api import VIDEOS_LIST_MAX_IDS
+
+# How long a batched stage waits for more items before running a partial batch
+BATCH_LINGER = 0.5
+
+
+class _Stage:
+    def __init__(self, name, handler, workers, queue_size, batch_size=1):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.next_stage = None
+
+
+class IngestPipeline:
+    # Fetches new videos for a set of channels. Each step of the ingest runs as
+    # its own stage with a fixed number of workers, and stages are joined by
+    # bounded queues so a slow stage (usually the LLM) holds back the ones
+    # before it instead of letting work pile up in memory.
+    def __init__(
+        self,
+        yt_api,
+        llm_handler,
+        db_handler,
+        settings,
+        should_cancel=lambda: False,
+        on_status=None,
+        on_progress=None,
+        on_video_added=None,
+    ):
+        self.yt_api = yt_api
+        self.llm_handler = llm_handler
+        self.db_handler = db_handler
+        self.should_cancel = should_cancel
+        self.on_status = on_status
+        self.on_progress = on_progress
+        self.on_video_added = on_video_added
+
+        queue_size = settings["ingest_queue_size"]
+        self.stages = [
+            _Stage(
+                "listing",
+                self.list_channel,
+                settings["ingest_listing_workers"],
+                queue_size,
+            ),
+            _Stage(
+                "details",
+                self.fetch_details,
+                settings["ingest_details_workers"],
+                # Has to hold a full batch for one videos.list call
+                max(queue_size, VIDEOS_LIST_MAX_IDS),
+                batch_size=VIDEOS_LIST_MAX_IDS,
+            ),
+            _Stage(
+                "transcript",
+                self.fetch_transcript,
+                # Matches the transcript thread pool so it is never left idle
+                settings["yt_transcript_workers"],
+                queue_size,
+            ),
+            _Stage(
+                "thumbnail",
+                self.fetch_thumbnail,
+                settings["yt_thumbnail_workers"],
+                queue_size,
+            ),
+            _Stage(
+                "classify",
+                self.classify,
+                settings["ingest_classify_workers"],
+                queue_size,
+            ),
+            # SQLite writes stay on a single worker
+            _Stage("store", self.store, 1, queue_size),
+        ]
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next_stage = next_stage
+
+        self.current_titles = {}
+        self.current_categories = []
+        self.seen_video_ids = set()
+        self.pending = {}
+        self.total_channels = 0
+        self.finished_channels = 0
+
+    async def run(self, channels):
+        video_ids, titles = await self.db_handler.get_current_video_ids_and_titles()
+        self.current_titles = dict(zip(video_ids, titles))
+        self.current_categories = await self.db_handler.get_categories_full()
+        self.total_channels = len(channels)
+        self.finished_channels = 0
+
+        workers = [
+            asyncio.create_task(self.stage_worker(stage))
+            for stage in self.stages
+            for _ in range(stage.workers)
+        ]
+
+        async def feed_and_drain():
+            for channel in channels:
+                if self.should_cancel():
+                    return
+                # Blocks once the listing queue is full
+                await self.stages[0].queue.put(channel)
+            # Each stage only marks an item done after handing its output to the
+            # next queue, so joining in order means everything has been stored
+            for stage in self.stages:
+                await stage.queue.join()
+
+        async def watch_cancel():
+            while not self.should_cancel():
+                await asyncio.sleep(0.25)
+
+        drain_task = asyncio.create_task(feed_and_drain())
+        cancel_task = asyncio.create_task(watch_cancel())
+        await asyncio.wait(
+            [drain_task, cancel_task], return_when=asyncio.FIRST_COMPLETED
+        )
+
+        if not drain_task.done():
+            print("Ingest cancelled, stopping workers")
+        for task in [drain_task, cancel_task, *workers]:
+            task.cancel()
+        await asyncio.gather(drain_task, cancel_task, *workers, return_exceptions=True)
+
+    async def next_batch(self, stage):
+        batch = [await stage.queue.get()]
+        if stage.batch_size == 1:
+            return batch
+
+        # Give upstream workers a moment to fill the batch, videos from several
+        # channels can then share one API call
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + BATCH_LINGER
+        while len(batch) < stage.batch_size:
+            if not stage.queue.empty():
+                batch.append(stage.queue.get_nowait())
+            elif loop.time() < deadline:
+                await asyncio.sleep(0.05)
+            else:
+                break
+        return batch
+
+    async def stage_worker(self, stage):
+        while True:
+            batch = await self.next_batch(stage)
+            try:
+                outputs = await stage.handler(
+                    batch if stage.batch_size > 1 else batch[0]
+                )
+            except Exception as e:
+                print(f"Exception in {stage.name} stage")
+                print(e)
+                outputs = []
+
+            try:
+                if stage.name == "listing":
+                    if not outputs:
+                        self.channel_done(batch[0])
+                else:
+                    # Videos that were dropped or stored are finished
+                    for item in batch:
+                        if not any(item is output for output in outputs):
+                            self.video_done(item["channel"])
+
+                for output in outputs:
+                    # Blocks while the next stage is saturated
+                    await stage.next_stage.queue.put(output)
+            finally:
+                for _ in batch:
+                    stage.queue.task_done()
+
+    def channel_done(self, channel):
+        self.pending.pop(channel, None)
+        self.finished_channels += 1
+        if self.on_progress is not None:
+            self.on_progress(self.finished_channels / self.total_channels)
+
+    def video_done(self, channel):
+        self.pending[channel] -= 1
+        if self.pending[channel] == 0:
+            self.channel_done(channel)
+
+    def status(self, text):
+        if self.on_status is not None:
+            self.on_status(text)
+
+    async def list_channel(self, channel):
+        self.status(f"Finding video ID's for {channel}")
+        recent_videos = await self.yt_api.get_recent_videos(channel)
+
+        new_videos = []
+        for video_id, video_title in recent_videos:
+            if video_id in self.current_titles:
+                current_title = self.current_titles[video_id]
+                if video_title != current_title:
+                    await self.db_handler.update_title(video_id, video_title)
+                    self.current_titles[video_id] = video_title
+                    print(f"{video_id} was renamed: {current_title} -> {video_title}")
+                    continue
+                print(
+                    f"{video_id} is already in database with matching title, skipping."
+                )
+                continue
+
+            # The same upload can show up on more than one listing in a run
+            if video_id in self.seen_video_ids:
+                continue
+            self.seen_video_ids.add(video_id)
+
+            new_videos.append({"channel": channel, "video_id": video_id})
+
+        self.pending[channel] = len(new_videos)
+        return new_videos
+
+    async def fetch_details(self, items):
+        details = await asyncio.to_thread(
+            self.yt_api.get_video_details_batch,
+            [item["video_id"] for item in items],
+            False,
+        )
+
+        found = []
+        for item in items:
+            if item["video_id"] in details:
+                item["video"] = details[item["video_id"]]
+                found.append(item)
+        return found
+
+    async def fetch_transcript(self, item):
+        video = item["video"]
+        video["transcript"] = await self.yt_api.get_transcript_async(video["url"])
+        return [item]
+
+    async def fetch_thumbnail(self, item):
+        item["thumbnail_bytes"] = await self.yt_api.get_thumbnail(
+            item["video"]["thumbnail"]
+        )
+        return [item]
+
+    async def classify(self, item):
+        video = item["video"]
+        self.status(f"Classifying {video['title']}")
+        # Stored along with the video so reprocessing can skip the extraction.
+        # Tokenizing a whole transcript would stall the event loop.
+        item["features"] = await asyncio.to_thread(
+            lambda: feature_extractor().transcript_features(video["transcript"])
+        )
+        # Also fills the classification cache for the next reprocess
+        video_categories, _ = await self.llm_handler.cached_categorize_video(
+            video["title"],
+            video["transcript"],
+            [c[0] for c in self.current_categories],
+            item["features"][2:],
+            self.db_handler,
+        )
+
+        item["category_ids"] = [
+            c[0]
+            for vc in video_categories
+            for c in self.current_categories
+            if c[0] == vc
+        ]
+        return [item]
+
+    async def store(self, item):
+        video = item["video"]
+        await self.db_handler.add_video(
+            item["video_id"],
+            item["channel"],
+            video["url"],
+            video["title"],
+            video["upload_date"],
+            item["thumbnail_bytes"],
+            video["tags"],
+            video["description"],
+            video["transcript"],
+            item["category_ids"],
+            item["features"],
+        )
+        self.current_titles[item["video_id"]] = video["title"]
+        print(f'Added {video["title"]} to db')
+
+        if self.on_video_added is not None:
+            await self.on_video_added()
+        return []
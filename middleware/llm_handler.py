@@ -1,84 +1,513 @@
+import asyncio
+import hashlib
 import json
-import nltk
-import string
-from ollama import AsyncClient as ollama_async
 import random
-from nltk.corpus import stopwords
-from nltk.probability import FreqDist
-from nltk.tokenize import word_tokenize
-from nltk.util import ngrams
+import time
 
-from middleware.sqlite_handler import DBHandler
+from middleware.features import feature_extractor, feature_pool, feature_sizes
+from middleware.settings import app_settings
 
-# Ensure nltk resources are downloaded
-nltk.data.path.append("./nltk_data")
-nltk.download("punkt_tab", download_dir="./nltk_data/", quiet=True)
-nltk.download("stopwords", download_dir="./nltk_data/", quiet=True)
 
+class OllamaClient:
+    # One client for the whole app so requests reuse kept alive connections to
+    # the server. At most ollama_parallel chats are in flight at once, going
+    # past what the server runs in parallel (OLLAMA_NUM_PARALLEL) only queues
+    # them on the server side.
+    def __init__(self):
+        # Imported here, ollama and httpx take a while to load and aren't
+        # needed until the first classification
+        import httpx
+        from ollama import AsyncClient as ollama_async
 
-class LLMHandler:
+        self.client = ollama_async(
+            limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=300)
+        )
+        self.slots = asyncio.Semaphore(app_settings["ollama_parallel"])
+        app_settings.subscribe(self.on_setting_changed)
+
+        # Ollama doesn't report how much of a prompt came from its cache. The
+        # first request with a new system prompt is taken as fully evaluated and
+        # later ones with the same system prompt are compared against it.
+        self.last_system_prompt = None
+        self.cold_prompt_tokens = 0
+        self.prompt_tokens_evaluated = 0
+        self.prompt_tokens_cached = 0
+        # Requests that didn't report their prompt tokens
+        self.prompt_tokens_unknown = 0
+
+    def on_setting_changed(self, name, value):
+        # Chats already running finish on the old limit
+        if name == "ollama_parallel":
+            self.slots = asyncio.Semaphore(value)
+
+    async def chat(self, **kwargs):
+        kwargs.setdefault("keep_alive", app_settings["ollama_keep_alive"])
+        async with self.slots:
+            response = await self.client.chat(**kwargs)
+        self.count_prompt_tokens(kwargs["messages"][0]["content"], response)
+        return response
+
+    async def chat_stream(self, until, **kwargs):
+        # Streams the reply and closes the connection as soon as until(content)
+        # is true, which makes ollama stop generating. Returns the reply in the
+        # same shape as chat() plus the time to the first token and to the
+        # answer. Token counts are only known if the model finished on its own.
+        kwargs.setdefault("keep_alive", app_settings["ollama_keep_alive"])
+        async with self.slots:
+            start = time.perf_counter()
+            first_token_time = None
+            content = ""
+            chunks = 0
+            last = {}
+            stream = await self.client.chat(stream=True, **kwargs)
+            try:
+                async for last in stream:
+                    if first_token_time is None:
+                        first_token_time = time.perf_counter() - start
+                    content += last["message"]["content"]
+                    chunks += 1
+                    if last.get("done") or until(content):
+                        break
+            finally:
+                await stream.aclose()
+            answer_time = time.perf_counter() - start
+
+        stopped_early = not last.get("done")
+        response = {
+            "message": {"role": "assistant", "content": content},
+            "done": not stopped_early,
+            "stopped_early": stopped_early,
+            # Each streamed chunk is one token
+            "eval_count": last.get("eval_count") or chunks,
+            "prompt_eval_count": last.get("prompt_eval_count"),
+            "total_duration": last.get("total_duration") or int(answer_time * 1e9),
+            "first_token_time": first_token_time or answer_time,
+            "answer_time": answer_time,
+        }
+        self.count_prompt_tokens(kwargs["messages"][0]["content"], response)
+        return response
+
+    def count_prompt_tokens(self, system_prompt, response):
+        evaluated = response.get("prompt_eval_count")
+        if evaluated is None:
+            # Streamed replies that were cut short never report it
+            self.prompt_tokens_unknown += 1
+            print("Prompt tokens: unknown, the reply was cut short")
+            return
+        if system_prompt != self.last_system_prompt:
+            self.last_system_prompt = system_prompt
+            self.cold_prompt_tokens = evaluated
+        cached = max(0, self.cold_prompt_tokens - evaluated)
+
+        self.prompt_tokens_evaluated += evaluated
+        self.prompt_tokens_cached += cached
+        print(f"Prompt tokens: {evaluated} evaluated, about {cached} cached")
+
+    def prompt_token_totals(self):
+        # (evaluated, cached, requests with unknown prompt tokens)
+        return (
+            self.prompt_tokens_evaluated,
+            self.prompt_tokens_cached,
+            self.prompt_tokens_unknown,
+        )
+
+
+# One video's entry in a batched classification prompt
+batch_video_template = """Video id: %s
+Video Title: "%s"
+Most frequent words in the transcript: %s
+Most frequent n-grams in the transcript: %s
+"""
+# Prompt and reply tokens each extra video adds to a batched request, roughly
+BATCH_TOKENS_PER_VIDEO = 250
+
+
+class ClassificationStats:
+    # Counts since the app started, take a snapshot to count over one run
     def __init__(self):
-        self.db_handler = DBHandler()
+        self.requests = 0
+        self.retries = 0
+        self.parse_failures = 0
+        self.made_up = 0
+        # Streamed classifications, see ollama_stream
+        self.streamed = 0
+        self.stopped_early = 0
+        self.first_token_time = 0.0
+        self.answer_time = 0.0
+
+    def snapshot(self):
+        return dict(vars(self))
+
+    def since(self, snapshot):
+        return {name: value - snapshot[name] for name, value in vars(self).items()}
 
+
+classification_stats = ClassificationStats()
+
+_ollama_client = None
+
+
+def ollama_client():
+    # Shared instance, created on first use
+    global _ollama_client
+    if _ollama_client is None:
+        _ollama_client = OllamaClient()
+    return _ollama_client
+
+
+class LLMHandler:
     def word_frequency(self, input_str, max_words=10, gram_len=3):
-        # Tokenize the transcript into words
-        if input_str is None:
-            return []
-
-        words = word_tokenize(
-            input_str.lower(), preserve_line=True
-        )  # lowercase for normalization
-
-        settings = self.db_handler.get_settings()
-        custom_stop_words = json.loads(settings["llm_custom_stop_words"])
-
-        # Merge custom stop words with nltk stop words
-        base_sw = stopwords.words("english")
-        # Add my custom words
-        base_sw.extend(custom_stop_words)
-        # Add all the single letters
-        base_sw.extend(list(string.ascii_lowercase))
-        stop_words = set(base_sw)
-
-        # Remove stop words
-        filtered_words = [
-            word for word in words if word.isalnum() and word not in stop_words
+        return feature_extractor().extract(input_str, max_words, gram_len)
+
+    async def video_features(self, video_id, transcript, db_handler):
+        # Reuses the stored features unless the transcript or extractor settings
+        # changed. Hashing and tokenizing run in a thread to keep the UI responsive.
+        extractor = await asyncio.to_thread(feature_extractor)
+        transcript_hash, settings_hash = await asyncio.to_thread(
+            extractor.cache_key, transcript
+        )
+        features = await db_handler.get_video_features(
+            video_id, transcript_hash, settings_hash
+        )
+        if features is None:
+            features = await asyncio.to_thread(
+                extractor.extract, transcript, *feature_sizes(transcript)
+            )
+            await db_handler.put_video_features(
+                video_id, transcript_hash, settings_hash, *features
+            )
+        return features
+
+    async def videos_features(self, videos, db_handler):
+        # Batched version of video_features, sets "features" on each video dict.
+        # Anything not stored yet is extracted by the process pool in one go.
+        # The keys hash every transcript, that runs on a thread.
+        keys = await asyncio.to_thread(
+            lambda: [
+                (video["id"], *feature_extractor().cache_key(video["transcript"]))
+                for video in videos
+            ]
+        )
+        stored = await db_handler.get_video_features_batch(keys)
+        missing = [video for video in videos if video["id"] not in stored]
+        extracted = await feature_pool().transcript_features(
+            [video["transcript"] for video in missing]
+        )
+        for video, features in zip(missing, extracted):
+            stored[video["id"]] = tuple(features[2:])
+        for video in videos:
+            video["features"] = stored[video["id"]]
+
+        if extracted:
+            await db_handler.put_video_features_batch(
+                [
+                    (video["id"], *features)
+                    for video, features in zip(missing, extracted)
+                ]
+            )
+        return videos
+
+    def classification_key(self, title, transcript, available_categories, features):
+        # Covers every input of the prompt. The example list and category order
+        # are shuffled on each call and deliberately left out. Batched and single
+        # replies share the cache, so both user prompts are part of the key.
+        prompts = (
+            app_settings["ollama_system_prompt"]
+            + app_settings["ollama_user_prompt"]
+            + app_settings["ollama_batch_user_prompt"]
+        )
+        key = [
+            app_settings["ollama_model"],
+            hashlib.sha256(prompts.encode()).hexdigest(),
+            app_settings["ollama_structured_output"],
+            sorted(available_categories),
+            title,
+            bool(transcript),
+            *features,
         ]
+        return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+    async def cached_categorize_video(
+        self, title, transcript, available_categories, features, db_handler
+    ):
+        # Returns (categories, True if they came from the cache)
+        cache_key = self.classification_key(
+            title, transcript, available_categories, features
+        )
+        categories = await db_handler.get_cached_classification(cache_key)
+        if categories is not None:
+            return categories, True
+
+        categories, ok = await self.categorize_video(
+            title, transcript, available_categories, features
+        )
+        # A fallback would otherwise be reused on every reprocess
+        if ok:
+            await db_handler.put_cached_classification(cache_key, categories)
+        return categories, False
+
+    async def cached_categorize_videos(self, videos, available_categories, db_handler):
+        # Batched version of cached_categorize_video, videos are dicts with id,
+        # title, transcript and features. Only cache misses go to the LLM.
+        results = {}
+        misses = []
+        for video in videos:
+            cache_key = self.classification_key(
+                video["title"],
+                video["transcript"],
+                available_categories,
+                video["features"],
+            )
+            categories = await db_handler.get_cached_classification(cache_key)
+            if categories is None:
+                misses.append((cache_key, video))
+            else:
+                results[video["id"]] = (categories, True)
+
+        if len(misses) == 1:
+            _, video = misses[0]
+            classified = {
+                video["id"]: await self.categorize_video(
+                    video["title"],
+                    video["transcript"],
+                    list(available_categories),
+                    video["features"],
+                )
+            }
+        elif misses:
+            classified = await self.categorize_videos(
+                [video for _, video in misses], list(available_categories)
+            )
+
+        for cache_key, video in misses:
+            categories, ok = classified[video["id"]]
+            if ok:
+                await db_handler.put_cached_classification(cache_key, categories)
+            results[video["id"]] = (categories, False)
+        return results
+
+    def prompt_categories(self, available_categories):
+        # (example list, category order for the system prompt, category order for
+        # the user prompt). Shuffled unless ollama_deterministic_prompt is set,
+        # in which case the system prompt is the same for every video.
+        if app_settings["ollama_deterministic_prompt"]:
+            ordered = sorted(available_categories)
+            others = [c for c in ordered if c not in ["Educational", "Entertainment"]]
+            return ["Educational", *others[:2]], ordered, ordered
+
+        example_list = [random.choice(["Educational", "Entertainment"])]
+        while len(example_list) < 3:
+            item = random.choice(available_categories)
+            if item not in example_list:
+                example_list.append(item)
+
+        system_categories = random.sample(
+            available_categories, len(available_categories)
+        )
+        user_categories = random.sample(available_categories, len(available_categories))
+        return example_list, system_categories, user_categories
+
+    def categories_schema(self, available_categories):
+        return {
+            "type": "array",
+            "items": {"type": "string", "enum": sorted(available_categories)},
+            "minItems": 1,
+            "maxItems": 3,
+            "uniqueItems": True,
+        }
+
+    def output_format(self, available_categories, video_ids=None):
+        # JSON schema for ollama_structured_output, the server then only lets the
+        # model produce a valid reply made of known categories. Batched replies
+        # are keyed by video id.
+        if not app_settings["ollama_structured_output"]:
+            return None
+
+        keys = ["categories"] if video_ids is None else video_ids
+        return {
+            "type": "object",
+            "properties": {
+                key: self.categories_schema(available_categories) for key in keys
+            },
+            "required": keys,
+        }
+
+    def parse_reply(self, content):
+        if app_settings["ollama_structured_output"]:
+            return list(json.loads(content)["categories"])
+
+        r = content.replace("]]", "]")
+        r = r.replace("```python", "")
+        r = r.replace("```", "")
+        return list(json.loads(r))
+
+    def reply_complete(self, content):
+        # A streamed reply can be cut off once it holds a whole answer, anything
+        # the model would add after it is commentary
+        if not content.rstrip().endswith(("]", "}")):
+            return False
+        try:
+            self.parse_reply(content)
+            return True
+        except Exception:
+            return False
+
+    async def classification_chat(self, **kwargs):
+        if not app_settings["ollama_stream"]:
+            return await ollama_client().chat(**kwargs)
+
+        response = await ollama_client().chat_stream(self.reply_complete, **kwargs)
+        classification_stats.streamed += 1
+        classification_stats.stopped_early += response["stopped_early"]
+        classification_stats.first_token_time += response["first_token_time"]
+        classification_stats.answer_time += response["answer_time"]
+        print(
+            f"First token: {response['first_token_time']:0.2f}s | Answer: {response['answer_time']:0.2f}s | Stopped early: {response['stopped_early']}"
+        )
+        return response
+
+    def chat_options(self, num_predict):
+        # Ollama reloads the model whenever num_ctx changes, so every request
+        # uses the context a full batch needs, however many videos it has
+        num_ctx = app_settings["ollama_ctx_size"] + BATCH_TOKENS_PER_VIDEO * (
+            app_settings["ollama_batch_size"] - 1
+        )
+        return {
+            "num_predict": num_predict,
+            "num_ctx": num_ctx,
+        }
+
+    def check_categories(self, categories, available_categories):
+        # One video's entry from a batched reply, None if it can't be used
+        if not isinstance(categories, list):
+            return None
+        known = [c for c in categories if c in available_categories]
+        classification_stats.made_up += len(categories) - len(known)
+        categories = known
+        if not categories:
+            return None
+
+        if ("Educational" not in categories) and ("Entertainment" not in categories):
+            categories.append("Entertainment")
+        return sorted(set(categories))
+
+    async def categorize_videos(self, videos, available_categories):
+        # Classifies several videos in one request so the system prompt and the
+        # category list are only evaluated once. The reply is a JSON object keyed
+        # by video id, videos with a missing or unusable entry are classified on
+        # their own afterwards. Returns {video_id: (categories, ok)} as
+        # categorize_video does.
+        print()
+        print(f"Classifying a batch of {len(videos)} videos")
 
-        grams = ngrams(filtered_words, gram_len)
+        example_list, system_categories, user_categories = self.prompt_categories(
+            available_categories
+        )
+        system_msg = app_settings["ollama_system_prompt"] % (
+            json.dumps(example_list),
+            json.dumps(system_categories),
+        )
+
+        video_entries = []
+        for video in videos:
+            top_words, top_grams = video["features"]
+            video_entries.append(
+                batch_video_template
+                % (
+                    video["id"],
+                    video["title"],
+                    ", ".join(top_words) or "No Top Words Available",
+                    ", ".join(top_grams) or "No Top Grams Available",
+                )
+            )
+        # Placeholder ids, the real ones would hand the model an answer
+        example_reply = {
+            f"video_id_{i + 1}": example_list for i in range(min(len(videos), 2))
+        }
+        classify_msg = app_settings["ollama_batch_user_prompt"] % (
+            "\n".join(video_entries),
+            json.dumps(example_reply),
+            json.dumps(user_categories),
+        )
 
-        # Get frequency distribution
-        word_freq = FreqDist(filtered_words)
-        gram_freq = FreqDist(grams)
+        try:
+            classification_stats.requests += 1
+            response = await ollama_client().chat(
+                model=app_settings["ollama_model"],
+                options=self.chat_options(
+                    500 + BATCH_TOKENS_PER_VIDEO * (len(videos) - 1)
+                ),
+                format=self.output_format(
+                    available_categories, [video["id"] for video in videos]
+                ),
+                messages=[
+                    {
+                        "role": "system",
+                        "content": system_msg,
+                    },
+                    {
+                        "role": "user",
+                        "content": classify_msg,
+                    },
+                ],
+            )
+            r = response["message"]["content"]
+            r = r.replace("```json", "").replace("```", "")
+            try:
+                reply = json.loads(r)
+                if not isinstance(reply, dict):
+                    raise ValueError(f"expected a JSON object, got {r}")
+            except ValueError:
+                classification_stats.parse_failures += 1
+                raise
 
-        # Display the most common words
-        top_words = word_freq.most_common(max_words)
-        top_grams = gram_freq.most_common(max_words)
+            inp_tokens = response["prompt_eval_count"]
+            print(
+                f"Proc Time: {response['total_duration'] / 1e9:0.2f} | Videos: {len(videos)} | Inp Tokens: {inp_tokens} ({inp_tokens / len(videos):0.0f} per video) | Out Tokens: {response['eval_count']}"
+            )
+        except Exception as e:
+            print("Batch classification failed, classifying the videos one at a time")
+            print(e)
+            reply = {}
 
-        # Filter out results that only appear a single time
-        # Drop out some of the result, more so on words than grams
-        top_words = [word for word, freq in top_words if freq >= 1]
-        top_grams = [" ".join(gram) for gram, freq in top_grams if freq >= 1]
+        results = {}
+        for video in videos:
+            categories = self.check_categories(
+                reply.get(video["id"]), available_categories
+            )
+            if categories is None:
+                print(f"No usable categories for {video['title']} in the batch reply")
+                results[video["id"]] = await self.categorize_video(
+                    video["title"],
+                    video["transcript"],
+                    list(available_categories),
+                    video["features"],
+                )
+            else:
+                results[video["id"]] = (categories, True)
 
-        return top_words, top_grams
+        print(f"Assigned: {results}")
+        return results
 
     # noinspection PyTypeChecker
-    async def categorize_video(self, title, transcript, available_categories):
+    async def categorize_video(
+        self, title, transcript, available_categories, features=None
+    ):
+        # Returns (categories, ok). ok is False when no usable category came
+        # back and the categories are only the Entertainment fallback, which
+        # shouldn't be cached.
         if transcript is None:
             transcript = ""
 
-        settings = self.db_handler.get_settings()
-
         response_string = ""
-        response_list = {}
+        response_list = []
         print()
         print(title)
 
         # Get most frequent non-stop words from the transcript to use
-        freq_dist_size = 25 if len(transcript) <= 10000 else 25
-        gram_len = 3 if len(transcript) <= 10000 else 4
-
-        top_words, top_grams = self.word_frequency(transcript, freq_dist_size, gram_len)
+        if features is None:
+            features = self.word_frequency(transcript, *feature_sizes(transcript))
+        top_words, top_grams = features
         print(
             f"{len(transcript)} transcript chars | {len(top_words)} top words | {len(top_grams)} bigrams"
         )
@@ -89,46 +518,40 @@ class LLMHandler:
 
         response = None
 
-        example_list = [random.choice(["Educational", "Entertainment"])]
-        while len(example_list) < 3:
-            item = random.choice(available_categories)
-            if item not in example_list:
-                example_list.append(item)
-            else:
-                continue
-
-        random.shuffle(available_categories)
+        example_list, system_categories, user_categories = self.prompt_categories(
+            available_categories
+        )
 
-        system_msg = settings["ollama_system_prompt"] % (
+        system_msg = app_settings["ollama_system_prompt"] % (
             json.dumps(example_list),
-            json.dumps(available_categories),
+            json.dumps(system_categories),
         )
 
-        random.shuffle(available_categories)
         if len(transcript) > 0:
-            classify_msg = settings["ollama_user_prompt"] % (
+            classify_msg = app_settings["ollama_user_prompt"] % (
                 ", ".join(top_words),
                 ", ".join(top_grams),
                 title,
-                json.dumps(available_categories),
+                json.dumps(user_categories),
             )
         else:
             print("No transcripts available :(")
-            classify_msg = settings["ollama_user_prompt"] % (
+            classify_msg = app_settings["ollama_user_prompt"] % (
                 "No Top Words Available",
                 "No Top Grams Available",
                 title,
-                json.dumps(available_categories),
+                json.dumps(user_categories),
             )
 
+        output_format = self.output_format(available_categories)
         for retry_count in range(5):
-            response = await ollama_async().chat(
-                model=settings["ollama_model"],
-                options={
-                    "num_predict": 500,
-                    "num_ctx": int(settings["ollama_ctx_size"]),
-                    "cache_prompt": False,
-                },
+            if retry_count > 0:
+                classification_stats.retries += 1
+            classification_stats.requests += 1
+            response = await self.classification_chat(
+                model=app_settings["ollama_model"],
+                options=self.chat_options(500),
+                format=output_format,
                 messages=[
                     {
                         "role": "system",
@@ -141,26 +564,22 @@ class LLMHandler:
                 ],
             )
             try:
-                r = response["message"]["content"].replace("]]", "]")
-                r = r.replace("```python", "")
-                r = r.replace("```", "")
-                data = list(json.loads(r))
-                assert isinstance(data, list)
+                self.parse_reply(response["message"]["content"])
                 break
             except Exception as e:
+                classification_stats.parse_failures += 1
                 print(response)
                 print(e)
                 continue
 
         try:
             print("Proper response obtained!")
-            r = response["message"]["content"].replace("]]", "]")
-            r = r.replace("```python", "")
-            r = r.replace("```", "")
-            response_string = r
-            response_list = list(json.loads(r))
+            response_string = response["message"]["content"]
+            response_list = self.parse_reply(response_string)
             response_tokens = response["eval_count"]
             inp_tokens = response["prompt_eval_count"]
+            if inp_tokens is None:
+                inp_tokens = "unknown"
             processing_time = response["total_duration"] / 1e9
             print(
                 f"Proc Time: {processing_time:0.2f} | Transcript Len: {len(transcript)} | Inp Tokens: {inp_tokens} | Out Tokens: {response_tokens} "
@@ -174,11 +593,11 @@ class LLMHandler:
             print("=============== EXCEPTION ===============")
             print()
 
-        made_up = 0
-        for item in response_list:
-            if item not in available_categories:
-                response_list.remove(item)
-                made_up += 1
+        known = [item for item in response_list if item in available_categories]
+        made_up = len(response_list) - len(known)
+        response_list = known
+        classification_stats.made_up += made_up
+        ok = len(response_list) > 0
 
         if ("Educational" not in response_list) and (
             "Entertainment" not in response_list
@@ -187,4 +606,4 @@ class LLMHandler:
 
         print(f"Assigned: {response_list} | Removed {made_up} made up categories.")
 
-        return sorted(response_list)
+        return sorted(response_list), ok
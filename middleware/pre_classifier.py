@@ -0,0 +1,193 @@
+import json
+
+import numpy as np
+
+from middleware.features import feature_extractor
+
+# Every category needs this many labelled videos before the classifier is used,
+# a newly added category has none and leaves everything to the LLM
+MIN_EXAMPLES = 5
+# Documents scored per step, bounds the (terms x categories) temporary
+SCORE_CHUNK = 1000
+# The prompt has the LLM pick exactly one of these, guesses follow the same rule
+EITHER_OR = ("Educational", "Entertainment")
+
+
+def video_terms(title, tags, top_words, top_grams):
+    # Title words, tags and the transcript features, prefixed so the same word
+    # counts separately as a tag or inside a gram
+    terms = feature_extractor().tokenize(title or "")
+    terms += [f"tag:{tag.lower()}" for tag in json.loads(tags or "[]")]
+    terms += top_words
+    terms += [f"gram:{gram}" for gram in top_grams]
+    return terms
+
+
+class PreClassifier:
+    # Guesses categories from the ones already assigned in the library, so only
+    # the videos it's unsure about need the LLM. Videos are sparse TF-IDF
+    # vectors over their terms. Each category scores videos against the
+    # centroid of its members minus the centroid of everything else, and is
+    # picked above the score that best separated the two when training.
+    def __init__(self, categories):
+        self.categories = list(categories)
+        self.vocabulary = {}
+        self.idf = None
+        self.centroids = None
+        self.thresholds = None
+        self.scales = None
+
+    def term_counts(self, documents, grow=False):
+        # Sparse (row, column, count) arrays, terms outside the vocabulary are
+        # dropped unless grow is set
+        rows = []
+        cols = []
+        for row, terms in enumerate(documents):
+            for term in terms:
+                col = self.vocabulary.get(term)
+                if col is None:
+                    if not grow:
+                        continue
+                    col = self.vocabulary[term] = len(self.vocabulary)
+                rows.append(row)
+                cols.append(col)
+
+        width = max(len(self.vocabulary), 1)
+        keys, counts = np.unique(
+            np.array(rows, dtype=np.int64) * width + np.array(cols, dtype=np.int64),
+            return_counts=True,
+        )
+        rows, cols = np.divmod(keys, width)
+        return rows, cols, counts
+
+    def weigh(self, rows, cols, counts, n_docs):
+        # Sublinear tf-idf, each document scaled to unit length
+        values = (1 + np.log(counts)) * self.idf[cols]
+        norms = np.sqrt(np.bincount(rows, weights=values**2, minlength=n_docs))
+        return values / np.maximum(norms, 1e-12)[rows]
+
+    def similarities(self, rows, cols, values, n_docs):
+        scores = np.zeros((n_docs, len(self.categories)), dtype=np.float32)
+        for c in range(len(self.categories)):
+            scores[:, c] = np.bincount(
+                rows, weights=values * self.centroids[cols, c], minlength=n_docs
+            )
+        return scores
+
+    def train(self, documents, labels):
+        # documents are term lists and labels the categories assigned to each.
+        # Returns False if there are too few examples to be trained.
+        n_docs = len(documents)
+        index = {category: i for i, category in enumerate(self.categories)}
+        members = np.zeros((n_docs, len(self.categories)), dtype=bool)
+        for row, categories in enumerate(labels):
+            for category in categories:
+                if category in index:
+                    members[row, index[category]] = True
+        examples = members.sum(axis=0)
+        if n_docs == 0 or examples.min() < MIN_EXAMPLES:
+            return False
+
+        rows, cols, counts = self.term_counts(documents, grow=True)
+        width = len(self.vocabulary)
+        df = np.bincount(cols, minlength=width)
+        self.idf = np.log((1 + n_docs) / (1 + df)) + 1
+        values = self.weigh(rows, cols, counts, n_docs)
+
+        self.centroids = np.zeros((width, len(self.categories)), dtype=np.float32)
+        for c in range(len(self.categories)):
+            member_terms = members[rows, c]
+            self.centroids[:, c] = self.centroid(
+                cols[member_terms], values[member_terms], width
+            ) - self.centroid(cols[~member_terms], values[~member_terms], width)
+
+        scores = self.similarities(rows, cols, values, n_docs)
+        self.thresholds = np.array(
+            [
+                self.best_threshold(scores[:, c], members[:, c])
+                for c in range(len(self.categories))
+            ]
+        )
+        self.scales = np.maximum(scores.std(axis=0), 1e-6)
+        return True
+
+    def centroid(self, cols, values, width):
+        centroid = np.bincount(cols, weights=values, minlength=width)
+        return centroid / max(np.linalg.norm(centroid), 1e-12)
+
+    def best_threshold(self, scores, members):
+        # The cut between sorted scores that misclassifies the fewest videos
+        order = np.argsort(scores)
+        scores = scores[order]
+        members = members[order]
+        # Cutting before position i gets the members below it and the
+        # non-members from it on wrong
+        members_below = np.concatenate([[0], np.cumsum(members)])
+        others_below = np.concatenate([[0], np.cumsum(~members)])
+        errors = members_below + (others_below[-1] - others_below)
+        i = int(np.argmin(errors))
+        if i == 0:
+            return scores[0] - 1e-6
+        if i == len(scores):
+            return scores[-1] + 1e-6
+        return (scores[i - 1] + scores[i]) / 2
+
+    def predict(self, documents):
+        # (categories, confidence) for each document. Confidence is how far the
+        # closest call was from its threshold, in standard deviations of that
+        # category's scores.
+        results = []
+        for start in range(0, len(documents), SCORE_CHUNK):
+            chunk = documents[start : start + SCORE_CHUNK]
+            rows, cols, counts = self.term_counts(chunk)
+            values = self.weigh(rows, cols, counts, len(chunk))
+            scores = self.similarities(rows, cols, values, len(chunk))
+            margins = (scores - self.thresholds) / self.scales
+            known_terms = np.bincount(rows, minlength=len(chunk))
+
+            for doc_margins, n_terms in zip(margins, known_terms):
+                order = np.argsort(-doc_margins)
+                # The higher scoring of the either/or pair, then up to three
+                # categories in total above their thresholds
+                pair = [i for i in order if self.categories[i] in EITHER_OR]
+                others = [
+                    i
+                    for i in order
+                    if self.categories[i] not in EITHER_OR and doc_margins[i] > 0
+                ]
+                chosen = (pair[:1] + others)[:3] or [order[0]]
+                categories = sorted(self.categories[i] for i in chosen)
+                # Nothing to go on for videos without any known terms
+                confidence = float(np.abs(doc_margins).min()) if n_terms else 0.0
+                results.append((categories, confidence))
+        return results
+
+
+def train_pre_classifier(labelled_videos, categories):
+    # labelled_videos as returned by get_labelled_videos, None if there isn't
+    # enough to train on
+    classifier = PreClassifier(categories)
+    documents = [
+        video_terms(video["title"], video["tags"], *video["features"])
+        for video in labelled_videos
+    ]
+    if not classifier.train(
+        documents, [video["categories"] for video in labelled_videos]
+    ):
+        return None
+    return classifier
+
+
+def guess_categories(classifier, videos, threshold):
+    # {video id: categories} for the videos the classifier is confident about
+    predictions = classifier.predict(
+        [
+            video_terms(video["title"], video["tags"], *video["features"])
+            for video in videos
+        ]
+    )
+    return {
+        video["id"]: categories
+        for video, (categories, confidence) in zip(videos, predictions)
+        if confidence >= threshold
+    }
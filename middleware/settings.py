@@ -0,0 +1,145 @@
+import json
+import re
+import threading
+
+from middleware import sqlite_handler
+from middleware.sqlite_handler import DBHandler, default_settings
+
+
+def parse_bool(value):
+    if value not in ["True", "False"]:
+        raise ValueError(f"expected True or False, got {value!r}")
+    return value == "True"
+
+
+def parse_positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise ValueError(f"expected a positive number, got {number}")
+    return number
+
+
+def parse_positive_float(value):
+    number = float(value)
+    if number <= 0:
+        raise ValueError(f"expected a positive number, got {number}")
+    return number
+
+
+def parse_word_list(value):
+    words = json.loads(value)
+    if not isinstance(words, list) or not all(isinstance(w, str) for w in words):
+        raise ValueError("expected a JSON list of strings")
+    return words
+
+
+def parse_duration(value):
+    # Seconds, or a duration such as 5m or 1h. Negative means forever.
+    value = str(value)
+    if re.fullmatch(r"-?\d+", value):
+        return int(value)
+    if not re.fullmatch(r"-?\d+(\.\d+)?(ms|s|m|h)", value):
+        raise ValueError(f"expected seconds or a duration like 5m, got {value!r}")
+    return value
+
+
+def parse_choice(*choices):
+    def parse(value):
+        if value not in choices:
+            raise ValueError(f"expected one of {', '.join(choices)}, got {value!r}")
+        return value
+
+    return parse
+
+
+# How each stored string becomes a typed value, settings not listed stay strings
+setting_parsers = {
+    "app_confirm_delete": parse_bool,
+    "app_tooltip_time": int,
+    "app_render_cache_mb": parse_positive_int,
+    "ollama_ctx_size": parse_positive_int,
+    "ollama_custom_stop_words": parse_word_list,
+    "ollama_tokenizer": parse_choice("regex", "nltk"),
+    "ollama_parallel": parse_positive_int,
+    "ollama_batch_size": parse_positive_int,
+    "ollama_deterministic_prompt": parse_bool,
+    "ollama_keep_alive": parse_duration,
+    "ollama_structured_output": parse_bool,
+    "ollama_stream": parse_bool,
+    "ollama_pre_classifier": parse_bool,
+    "ollama_pre_classifier_threshold": parse_positive_float,
+    "ingest_listing_workers": parse_positive_int,
+    "ingest_details_workers": parse_positive_int,
+    "ingest_classify_workers": parse_positive_int,
+    "ingest_queue_size": parse_positive_int,
+    "yt_listing_backend": parse_choice("feed", "api", "scrape"),
+    "yt_transcript_workers": parse_positive_int,
+    "yt_transcript_timeout": parse_positive_float,
+    "yt_transcript_retries": parse_positive_int,
+    "yt_thumbnail_workers": parse_positive_int,
+    "yt_thumbnail_timeout": parse_positive_float,
+}
+
+
+class SettingsService:
+    # Settings are read from the database once and kept parsed in memory. Every
+    # put_setting updates the cache, and subscribers are told which setting changed.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.raw_values = None
+        self.values = None
+        self.subscribers = []
+        sqlite_handler.setting_listeners.append(self.on_setting_written)
+
+    def parse(self, name, value):
+        parser = setting_parsers.get(name)
+        if parser is None:
+            return value
+        try:
+            return parser(value)
+        except (ValueError, TypeError) as e:
+            print(f"Invalid value for setting {name}, using the default")
+            print(e)
+            return parser(default_settings[name])
+
+    def load(self):
+        with self.lock:
+            if self.values is None:
+                self.raw_values = DBHandler().get_settings()
+                self.values = {
+                    name: self.parse(name, value)
+                    for name, value in self.raw_values.items()
+                }
+
+    def __getitem__(self, name):
+        if self.values is None:
+            self.load()
+        return self.values[name]
+
+    def raw(self):
+        # The stored strings, for editing on the settings page
+        if self.values is None:
+            self.load()
+        return dict(self.raw_values)
+
+    def put(self, name, value):
+        DBHandler().put_setting(name, value)
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def on_setting_written(self, name, value):
+        if self.values is None:
+            return
+
+        with self.lock:
+            if self.raw_values.get(name) == value:
+                return
+            self.raw_values[name] = value
+            self.values[name] = self.parse(name, value)
+
+        for callback in self.subscribers:
+            callback(name, self.values[name])
+
+
+app_settings = SettingsService()
@@ -1,7 +1,20 @@
 import json
 import sqlite3
+from contextlib import contextmanager
+
+from middleware.db_connections import ConnectionManager
 
 DB_FILE = "data.db3"
+# SQLite before 3.32 allows at most 999 bound parameters in one statement, longer
+# IN lists are split into chunks of this size
+MAX_IN_PARAMS = 900
+
+
+def in_chunks(values):
+    values = list(values)
+    for start in range(0, len(values), MAX_IN_PARAMS):
+        yield values[start : start + MAX_IN_PARAMS]
+
 
 default_system_prompt = """You are an assistant AI that returns a category classifications from video information.
 Please output a single line Python list object
@@ -36,6 +49,16 @@ Most frequent bigrams in the transcript (may be empty):
 
 Video Title: "%s"
 
+As a reminder, these are the categories to use in classification: %s
+"""
+# Used instead of the user prompt when several videos share one request
+default_batch_user_prompt = """Classify each of the following videos:
+
+%s
+
+Instead of a single list, reply with one single line JSON object that maps every video id to the list of categories for that video, for example:
+%s
+
 As a reminder, these are the categories to use in classification: %s
 """
 default_custom_stop_words = [
@@ -68,13 +91,111 @@ default_custom_stop_words = [
     "well",
     "oh",
 ]
+feed_channels_table_query = "CREATE TABLE IF NOT EXISTS feed_channels (username TEXT PRIMARY KEY, channel_id TEXT NOT NULL, uploads_playlist TEXT NOT NULL, FOREIGN KEY (username) REFERENCES feeds(username) ON DELETE CASCADE)"
+# Thumbnails live apart from the videos so grid queries never page through image bytes
+thumbnails_table_query = "CREATE TABLE IF NOT EXISTS thumbnails (video_id TEXT PRIMARY KEY NOT NULL, thumbnail BLOB NOT NULL, FOREIGN KEY (video_id) REFERENCES videos(video_id) ON DELETE CASCADE)"
+# Top words and n-grams pulled from each transcript, reused until the transcript
+# or the feature extractor settings change
+video_features_table_query = "CREATE TABLE IF NOT EXISTS video_features (video_id TEXT PRIMARY KEY NOT NULL, transcript_hash TEXT NOT NULL, settings_hash TEXT NOT NULL, top_words TEXT NOT NULL, top_grams TEXT NOT NULL, FOREIGN KEY (video_id) REFERENCES videos(video_id) ON DELETE CASCADE)"
+put_video_features_query = "INSERT OR REPLACE INTO video_features (video_id, transcript_hash, settings_hash, top_words, top_grams) VALUES (?, ?, ?, ?, ?)"
+# Categories the LLM returned, keyed by a hash of everything that went into the prompt
+classification_cache_table_query = "CREATE TABLE IF NOT EXISTS classification_cache (cache_key TEXT PRIMARY KEY NOT NULL, categories TEXT NOT NULL)"
+index_queries = [
+    # Each category can only be assigned to a video once, also covers lookups by video
+    "CREATE UNIQUE INDEX IF NOT EXISTS video_categories_video_idx ON video_categories (video_id, llm_category)",
+    # Category filters and deletes
+    "CREATE INDEX IF NOT EXISTS video_categories_category_idx ON video_categories (llm_category, video_id)",
+    # Feed filters and deletes
+    "CREATE INDEX IF NOT EXISTS videos_username_idx ON videos (username)",
+    # Grid order and keyset pagination
+    "CREATE INDEX IF NOT EXISTS videos_upload_date_idx ON videos (upload_date, video_id)",
+]
+default_settings = {
+    "app_confirm_delete": "True",
+    "app_tooltip_time": "1000",
+    # Memory budget for the encoded thumbnails kept by the video grid
+    "app_render_cache_mb": "64",
+    "yt_api_key": "Fill in this value...",
+    "ollama_model": "qwen2.5-coder:7b",
+    "ollama_ctx_size": "1200",
+    "ollama_system_prompt": default_system_prompt,
+    "ollama_user_prompt": default_user_prompt,
+    "ollama_batch_user_prompt": default_batch_user_prompt,
+    # Videos per classification request when reprocessing, 1 sends them one at a time
+    "ollama_batch_size": "1",
+    # Same system prompt and category order on every request, so the server can
+    # reuse the evaluated prompt prefix instead of shuffling them
+    "ollama_deterministic_prompt": "False",
+    # How long the model stays loaded after a request, e.g. 5m, or -1 for forever.
+    # Ollama reuses the evaluated prompt prefix only while the model is loaded.
+    "ollama_keep_alive": "5m",
+    # Give ollama a JSON schema listing the categories, needs ollama 0.5 or newer
+    "ollama_structured_output": "False",
+    # Stream single video classifications and stop the model once a full list
+    # of categories has arrived
+    "ollama_stream": "True",
+    # Guess categories from the ones already assigned before asking the LLM,
+    # only videos scoring below the confidence threshold go to the LLM
+    "ollama_pre_classifier": "True",
+    "ollama_pre_classifier_threshold": "0.5",
+    "ollama_custom_stop_words": json.dumps(default_custom_stop_words),
+    # Classification requests sent to ollama at the same time, best kept at or
+    # below the server's OLLAMA_NUM_PARALLEL
+    "ollama_parallel": "2",
+    # Transcript tokenizer for the prompt features: regex (faster) or nltk
+    "ollama_tokenizer": "regex",
+    # Ingest pipeline tuning, number of concurrent workers per stage
+    "ingest_listing_workers": "2",
+    "ingest_details_workers": "1",
+    "ingest_classify_workers": "1",
+    "ingest_queue_size": "16",
+    # How channel uploads are listed: feed, api or scrape
+    "yt_listing_backend": "feed",
+    # Transcript downloads, threads in the pool and seconds per attempt
+    "yt_transcript_workers": "4",
+    "yt_transcript_timeout": "60",
+    "yt_transcript_retries": "3",
+    # Thumbnail downloads, concurrent requests and seconds per request
+    "yt_thumbnail_workers": "4",
+    "yt_thumbnail_timeout": "15",
+}
+# Called with (name, value) after every put_setting
+setting_listeners = []
+
+
+connections = ConnectionManager(DB_FILE)
 
 
 class DBHandler:
-    def __init__(self):
-        self.conn = sqlite3.connect(DB_FILE)
+    # Handlers share the connections held by the connection manager. Background
+    # jobs (ingest, reprocessing) pass background=True to write on their own
+    # connection so they don't hold up the UI.
+    def __init__(self, background=False, conn=None):
+        if conn is None:
+            if background:
+                conn = connections.background_connection()
+            else:
+                conn = connections.main_connection()
+        self.conn = conn
         self.cur = self.conn.cursor()
-        self.initialize()
+
+        # The schema only needs checking once per run
+        if not connections.initialized:
+            with connections.lock:
+                if not connections.initialized:
+                    self.initialize()
+                    connections.initialized = True
+
+    @classmethod
+    @contextmanager
+    def reader(cls):
+        # Read only handler on a pooled connection, used by the video grid since
+        # its fetches come from Flet's handler threads as well as the event loop.
+        # Readers are query only, so the schema is set up on the main connection.
+        if not connections.initialized:
+            cls()
+        with connections.reader() as conn:
+            yield cls(conn=conn)
 
     def initialize(self):
         # Check if schema exists
@@ -86,6 +207,35 @@ class DBHandler:
             self.create_schema()
             self.conn.commit()
 
+        # Bring databases made by older versions up to date
+        self.migrate()
+        # Settings added or removed after the schema was first created
+        self.add_missing_settings()
+
+    def migrations(self):
+        # Each migration upgrades the schema by one version, PRAGMA user_version
+        # holds the last one applied. Only ever append to this list.
+        return [
+            self.add_feed_channels_table,
+            self.move_thumbnails_to_store,
+            self.add_indexes,
+            self.add_video_features_table,
+            self.add_classification_cache_table,
+        ]
+
+    def migrate(self):
+        migrations = self.migrations()
+
+        self.cur.execute("PRAGMA user_version")
+        version = self.cur.fetchone()[0]
+
+        for number, migration in enumerate(migrations[version:], start=version + 1):
+            print(f"Migrating database to version {number}")
+            with self.conn:
+                migration()
+                self.cur.execute(f"PRAGMA user_version = {number}")
+            print("Done")
+
     def create_schema(self):
         print("Creating tables")
         create_tables_queries = [
@@ -93,43 +243,92 @@ class DBHandler:
             "CREATE TABLE IF NOT EXISTS feeds (username TEXT PRIMARY KEY, display_name TEXT)",
             "CREATE TABLE IF NOT EXISTS categories (llm_category TEXT PRIMARY KEY, display_category TEXT NOT NULL UNIQUE)",
             "CREATE TABLE IF NOT EXISTS video_categories (video_id TEXT, llm_category TEXT, FOREIGN KEY (video_id) REFERENCES videos(video_id), FOREIGN KEY (llm_category) REFERENCES categories(llm_category))",
-            "CREATE TABLE IF NOT EXISTS videos (video_id TEXT PRIMARY KEY NOT NULL UNIQUE, username TEXT, url TEXT NOT NULL, title TEXT NOT NULL, upload_date DATE, thumbnail BLOB, tags TEXT, description TEXT, transcript TEXT, FOREIGN KEY (username) REFERENCES feeds(username) ON DELETE CASCADE)",
+            "CREATE TABLE IF NOT EXISTS videos (video_id TEXT PRIMARY KEY NOT NULL UNIQUE, username TEXT, url TEXT NOT NULL, title TEXT NOT NULL, upload_date DATE, tags TEXT, description TEXT, transcript TEXT, FOREIGN KEY (username) REFERENCES feeds(username) ON DELETE CASCADE)",
+            feed_channels_table_query,
+            thumbnails_table_query,
+            video_features_table_query,
+            classification_cache_table_query,
+            *index_queries,
         ]
         for query in create_tables_queries:
             self.cur.execute(query)
+        # A new schema is already at the latest version
+        self.cur.execute(f"PRAGMA user_version = {len(self.migrations())}")
         self.conn.commit()
         print("Done")
 
         # Add default settings
         print("Adding default settings")
-        self.put_setting("app_confirm_delete", "True")
-        self.put_setting("app_tooltip_time", "1000")
-        self.put_setting("yt_api_key", "Fill in this value...")
-        self.put_setting("ollama_model", "qwen2.5-coder:7b")
-        self.put_setting("ollama_ctx_size", "1200")
-        self.put_setting("ollama_system_prompt", default_system_prompt)
-        self.put_setting("ollama_user_prompt", default_user_prompt)
-        self.put_setting(
-            "ollama_custom_stop_words", json.dumps(default_custom_stop_words)
-        )
+        for name, value in default_settings.items():
+            self.put_setting(name, value)
         print("Done")
 
-    def add_feed(self, username, display_name):
+    def add_feed_channels_table(self):
+        self.cur.execute(feed_channels_table_query)
+
+    def move_thumbnails_to_store(self):
+        self.cur.execute(thumbnails_table_query)
+
+        self.cur.execute("PRAGMA table_info(videos)")
+        if "thumbnail" not in [c[1] for c in self.cur.fetchall()]:
+            return
+
+        print("Moving thumbnails out of the videos table")
         self.cur.execute(
-            "INSERT INTO feeds (username, display_name) VALUES (?, ?)",
-            (username, display_name),
+            "INSERT OR IGNORE INTO thumbnails (video_id, thumbnail) SELECT video_id, thumbnail FROM videos WHERE thumbnail IS NOT NULL"
         )
         self.conn.commit()
-
-    def add_category(self, llm_category, display_category):
+        # Rewrites the videos table without the image bytes
+        try:
+            self.cur.execute("ALTER TABLE videos DROP COLUMN thumbnail")
+        except sqlite3.OperationalError:
+            # SQLite older than 3.35 can't drop columns, empty it instead
+            self.cur.execute("UPDATE videos SET thumbnail = NULL")
+
+    def add_indexes(self):
+        # Drop duplicate category assignments so the unique index can be built
         self.cur.execute(
-            "INSERT INTO categories (llm_category, display_category) VALUES (?, ?)",
-            (
-                llm_category,
-                display_category,
-            ),
+            """
+            DELETE FROM video_categories
+            WHERE rowid NOT IN (
+                SELECT MIN(rowid) FROM video_categories GROUP BY video_id, llm_category
+            )
+            """
         )
-        self.conn.commit()
+        for query in index_queries:
+            self.cur.execute(query)
+        # Give the query planner statistics for the new indexes
+        self.cur.execute("ANALYZE")
+
+    def add_video_features_table(self):
+        self.cur.execute(video_features_table_query)
+
+    def add_classification_cache_table(self):
+        self.cur.execute(classification_cache_table_query)
+
+    def add_missing_settings(self):
+        with self.conn:
+            self.cur.executemany(
+                "INSERT OR IGNORE INTO settings (setting, setting_value) VALUES (?, ?)",
+                default_settings.items(),
+            )
+
+    def add_feed(self, username, display_name):
+        with self.conn:
+            self.cur.execute(
+                "INSERT INTO feeds (username, display_name) VALUES (?, ?)",
+                (username, display_name),
+            )
+
+    def add_category(self, llm_category, display_category):
+        with self.conn:
+            self.cur.execute(
+                "INSERT INTO categories (llm_category, display_category) VALUES (?, ?)",
+                (
+                    llm_category,
+                    display_category,
+                ),
+            )
 
     def add_video(
         self,
@@ -143,34 +342,51 @@ class DBHandler:
         description,
         transcript,
         categories,
+        features=None,
     ):
-        # Insert video
-        self.cur.execute(
-            "INSERT INTO videos (video_id, username, url, title, upload_date, thumbnail, tags, description, transcript) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (
-                video_id,
-                feed_id,
-                url,
-                title,
-                upload_date,
-                thumbnail,
-                tags,
-                description,
-                transcript,
-            ),
-        )
-        # Insert video categories
-        for category in categories:
+        with self.conn:
+            # Insert video
             self.cur.execute(
-                "INSERT INTO video_categories (video_id, llm_category) VALUES (?, ?)",
-                (video_id, category),
+                "INSERT INTO videos (video_id, username, url, title, upload_date, tags, description, transcript) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    video_id,
+                    feed_id,
+                    url,
+                    title,
+                    upload_date,
+                    tags,
+                    description,
+                    transcript,
+                ),
             )
-        self.conn.commit()
+            self.cur.execute(
+                "INSERT OR REPLACE INTO thumbnails (video_id, thumbnail) VALUES (?, ?)",
+                (video_id, thumbnail),
+            )
+            # Features extracted while classifying, saves redoing them on reprocess
+            if features is not None:
+                transcript_hash, settings_hash, top_words, top_grams = features
+                self.cur.execute(
+                    put_video_features_query,
+                    (
+                        video_id,
+                        transcript_hash,
+                        settings_hash,
+                        json.dumps(top_words),
+                        json.dumps(top_grams),
+                    ),
+                )
+            # Insert video categories
+            for category in categories:
+                self.cur.execute(
+                    "INSERT OR IGNORE INTO video_categories (video_id, llm_category) VALUES (?, ?)",
+                    (video_id, category),
+                )
 
     def get_uncategorized_videos(self):
         self.cur.execute(
             """
-            SELECT v.video_id, v.username, v.url, v.title, v.upload_date, v.thumbnail, v.tags, v.description, v.transcript
+            SELECT v.video_id, v.username, v.url, v.title, v.upload_date, v.tags, v.description, v.transcript
             FROM videos v
             LEFT JOIN video_categories vc ON v.video_id = vc.video_id
             WHERE vc.video_id IS NULL;
@@ -191,10 +407,9 @@ class DBHandler:
                 "url": row[2],
                 "title": row[3],
                 "upload_date": row[4],
-                "thumbnail": row[5],
-                "tags": row[6],
-                "description": row[7],
-                "transcript": row[8],
+                "tags": row[5],
+                "description": row[6],
+                "transcript": row[7],
             }
             uncategorized_videos.append(video_dict)
 
@@ -202,39 +417,50 @@ class DBHandler:
         return uncategorized_videos
 
     def bulk_add_video_category(self, data):
-        for item in data:
-            video_id, llm_category = item
-            # print(f"Adding item {video_id} | {llm_category}")
-            self.cur.execute(
-                "INSERT INTO video_categories (video_id, llm_category) VALUES (?, ?)",
-                (video_id, llm_category),
-            )
-        self.conn.commit()
+        with self.conn:
+            for item in data:
+                video_id, llm_category = item
+                # print(f"Adding item {video_id} | {llm_category}")
+                self.cur.execute(
+                    "INSERT OR IGNORE INTO video_categories (video_id, llm_category) VALUES (?, ?)",
+                    (video_id, llm_category),
+                )
 
     def truncate_video_categories(self):
-        self.cur.execute("DELETE FROM video_categories;")
-        self.conn.commit()
+        with self.conn:
+            self.cur.execute("DELETE FROM video_categories;")
 
     def delete_feed(self, username):
-        # Delete videos associated with the feed
-        self.cur.execute(
-            "DELETE FROM videos WHERE username = ?",
-            (username,),
-        )
-        # Delete the feed itself
-        self.cur.execute("DELETE FROM feeds WHERE username = ?", (username,))
-        self.conn.commit()
+        with self.conn:
+            # Delete videos associated with the feed
+            self.cur.execute(
+                "DELETE FROM thumbnails WHERE video_id IN (SELECT video_id FROM videos WHERE username = ?)",
+                (username,),
+            )
+            self.cur.execute(
+                "DELETE FROM video_features WHERE video_id IN (SELECT video_id FROM videos WHERE username = ?)",
+                (username,),
+            )
+            self.cur.execute(
+                "DELETE FROM videos WHERE username = ?",
+                (username,),
+            )
+            self.cur.execute(
+                "DELETE FROM feed_channels WHERE username = ?", (username,)
+            )
+            # Delete the feed itself
+            self.cur.execute("DELETE FROM feeds WHERE username = ?", (username,))
 
     def delete_category(self, llm_category):
-        # Delete video categories associated with the category
-        self.cur.execute(
-            "DELETE FROM video_categories WHERE llm_category = ?", (llm_category,)
-        )
-        # Delete the category itself
-        self.cur.execute(
-            "DELETE FROM categories WHERE llm_category = ?", (llm_category,)
-        )
-        self.conn.commit()
+        with self.conn:
+            # Delete video categories associated with the category
+            self.cur.execute(
+                "DELETE FROM video_categories WHERE llm_category = ?", (llm_category,)
+            )
+            # Delete the category itself
+            self.cur.execute(
+                "DELETE FROM categories WHERE llm_category = ?", (llm_category,)
+            )
 
     def get_channel_usernames(self):
         self.cur.execute(
@@ -242,6 +468,21 @@ class DBHandler:
         )
         return [c[0] for c in self.cur.fetchall()]
 
+    def get_feed_channel(self, username):
+        self.cur.execute(
+            "SELECT channel_id, uploads_playlist FROM feed_channels WHERE username = ?",
+            (username,),
+        )
+        row = self.cur.fetchone()
+        return None if row is None else (row[0], row[1])
+
+    def put_feed_channel(self, username, channel_id, uploads_playlist):
+        with self.conn:
+            self.cur.execute(
+                "INSERT OR REPLACE INTO feed_channels (username, channel_id, uploads_playlist) VALUES (?, ?, ?)",
+                (username, channel_id, uploads_playlist),
+            )
+
     def get_feed_display(self):
         self.cur.execute("SELECT display_name FROM feeds ORDER BY display_name ASC")
         return [f[0] for f in self.cur.fetchall()]
@@ -269,40 +510,92 @@ class DBHandler:
         return [c[0] for c in self.cur.fetchall()]
 
     def get_full_video_data(self):
-        self.cur.execute(
-            "SELECT video_id, url, title, upload_date, thumbnail, tags, description, transcript FROM videos"
+        return [video for batch in self.iter_full_video_data() for video in batch]
+
+    def iter_full_video_data(self, batch_size=100):
+        # Own cursor so other calls on this handler can run between batches
+        cur = self.conn.cursor()
+        cur.execute(
+            "SELECT video_id, url, title, upload_date, tags, description, transcript FROM videos"
         )
-        return [
-            {
-                "id": v[0],
-                "url": v[1],
-                "title": v[2],
-                "upload_date": v[3],
-                "thumbnail": v[4],
-                "tags": v[5],
-                "description": v[6],
-                "transcript": v[7],
-            }
-            for v in self.cur.fetchall()
-        ]
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [
+                {
+                    "id": v[0],
+                    "url": v[1],
+                    "title": v[2],
+                    "upload_date": v[3],
+                    "tags": v[4],
+                    "description": v[5],
+                    "transcript": v[6],
+                }
+                for v in rows
+            ]
 
-    def update_title(self, video_id, new_title):
+    def get_labelled_videos(self):
+        # Videos with at least one category, with their stored transcript
+        # features when there are any
         self.cur.execute(
-            "UPDATE videos SET title = ? WHERE video_id = ?", (new_title, video_id)
+            """
+            SELECT v.video_id, v.title, v.tags, vf.top_words, vf.top_grams, vc.llm_category
+            FROM video_categories vc
+            JOIN videos v ON v.video_id = vc.video_id
+            LEFT JOIN video_features vf ON vf.video_id = v.video_id
+            ORDER BY v.video_id
+            """
         )
-        self.conn.commit()
+        videos = []
+        for row in self.cur.fetchall():
+            if not videos or videos[-1]["id"] != row[0]:
+                videos.append(
+                    {
+                        "id": row[0],
+                        "title": row[1],
+                        "tags": row[2],
+                        "features": (
+                            json.loads(row[3] or "[]"),
+                            json.loads(row[4] or "[]"),
+                        ),
+                        "categories": [],
+                    }
+                )
+            videos[-1]["categories"].append(row[5])
+        return videos
 
-    def video_grid_query_construct(self, feed_filters, category_filters, limit):
+    def count_videos(self):
+        self.cur.execute("SELECT COUNT(*) FROM videos")
+        return self.cur.fetchone()[0]
+
+    def update_title(self, video_id, new_title):
+        with self.conn:
+            self.cur.execute(
+                "UPDATE videos SET title = ? WHERE video_id = ?", (new_title, video_id)
+            )
+
+    def video_grid_query_construct(self, feed_filters, category_filters, after, limit):
+        # Pages are counted in videos, not joined category rows, and walk the grid
+        # by (upload_date, video_id) so every page costs the same to fetch
         query = """
-                SELECT v.video_id, f.username, f.display_name, v.url, v.title, v.upload_date, v.thumbnail, c.display_category
+                SELECT v.video_id, f.username, f.display_name, v.url, v.title, v.upload_date
                 FROM videos v
-                JOIN video_categories vc ON v.video_id = vc.video_id
-                JOIN categories c ON vc.llm_category = c.llm_category
                 JOIN feeds f ON v.username = f.username
             """
 
         # Construct the WHERE clause based on feed_filters and category_filters
-        where_clauses = []
+        # Videos without any categories are left out of the grid
+        where_clauses = [
+            """
+                EXISTS (
+                    SELECT 1
+                    FROM video_categories vc
+                    JOIN categories c ON vc.llm_category = c.llm_category
+                    WHERE vc.video_id = v.video_id
+                )
+            """
+        ]
 
         if feed_filters:
             feed_placeholders = ", ".join(["?"] * len(feed_filters))
@@ -323,10 +616,12 @@ class DBHandler:
                 """
             )
 
-        if where_clauses:
-            query += " WHERE " + " AND ".join(where_clauses)
+        if after is not None:
+            where_clauses.append("(v.upload_date, v.video_id) < (?, ?)")
+
+        query += " WHERE " + " AND ".join(where_clauses)
 
-        query += " ORDER BY v.upload_date DESC LIMIT ?;"
+        query += " ORDER BY v.upload_date DESC, v.video_id DESC LIMIT ?;"
 
         # Prepare the parameters for the query
         params = []
@@ -337,49 +632,74 @@ class DBHandler:
             params.append(
                 len(category_filters)
             )  # Add the count of categories for the HAVING clause
+        if after is not None:
+            params.extend(after)
         params.append(limit)
 
         return query, tuple(params)
 
-    def get_video_grid_data(self, feed_filters, category_filters, limit=100):
+    def get_video_grid_page(
+        self, feed_filters, category_filters, after=None, page_size=50
+    ):
         # Thank you qwen2.5-coder:32b for giving me the function to construct a query
         # that or's the feeds and and's the categories
         query, params = self.video_grid_query_construct(
-            feed_filters, category_filters, limit
+            feed_filters, category_filters, after, page_size
         )
         self.cur.execute(query, params)
         results = self.cur.fetchall()
 
-        videos = []
         video_dict = {}
         for row in results:
-            (
-                video_id,
-                username,
-                display_name,
-                url,
-                title,
-                upload_date,
-                thumbnail,
-                category,
-            ) = row
-            if video_id not in video_dict:
-                video_dict[video_id] = {
-                    "id": video_id,
-                    "url": url,
-                    "username": username,
-                    "display_name": display_name,
-                    "title": title,
-                    "upload_date": upload_date,
-                    "thumbnail": thumbnail,
-                    "categories": [],
-                }
-            video_dict[video_id]["categories"].append(category)
+            video_id, username, display_name, url, title, upload_date = row
+            video_dict[video_id] = {
+                "id": video_id,
+                "url": url,
+                "username": username,
+                "display_name": display_name,
+                "title": title,
+                "upload_date": upload_date,
+                "categories": [],
+            }
 
-        for _, video in video_dict.items():
-            videos.append(video)
+        for chunk in in_chunks(video_dict):
+            placeholders = ", ".join(["?"] * len(chunk))
+            self.cur.execute(
+                f"""
+                SELECT vc.video_id, c.display_category
+                FROM video_categories vc
+                JOIN categories c ON vc.llm_category = c.llm_category
+                WHERE vc.video_id IN ({placeholders})
+                """,
+                chunk,
+            )
+            for video_id, category in self.cur.fetchall():
+                video_dict[video_id]["categories"].append(category)
 
-        return videos
+        videos = list(video_dict.values())
+
+        # A short page means there is nothing left to fetch
+        cursor = None
+        if len(videos) == page_size:
+            cursor = (videos[-1]["upload_date"], videos[-1]["id"])
+
+        return videos, cursor
+
+    def get_video_grid_data(self, feed_filters, category_filters, limit=100):
+        return self.get_video_grid_page(
+            feed_filters, category_filters, page_size=limit
+        )[0]
+
+    def get_thumbnails(self, video_ids):
+        thumbnails = {}
+        for chunk in in_chunks(video_ids):
+            placeholders = ", ".join(["?"] * len(chunk))
+            self.cur.execute(
+                f"SELECT video_id, thumbnail FROM thumbnails WHERE video_id IN ({placeholders})",
+                chunk,
+            )
+            thumbnails.update({t[0]: t[1] for t in self.cur.fetchall()})
+        return thumbnails
 
     def get_video_transcript(self, video_id):
         self.cur.execute(
@@ -387,9 +707,82 @@ class DBHandler:
         )
         return self.cur.fetchone()[0]
 
+    def get_video_features(self, video_id, transcript_hash, settings_hash):
+        self.cur.execute(
+            "SELECT top_words, top_grams FROM video_features WHERE video_id = ? AND transcript_hash = ? AND settings_hash = ?",
+            (video_id, transcript_hash, settings_hash),
+        )
+        row = self.cur.fetchone()
+        return None if row is None else (json.loads(row[0]), json.loads(row[1]))
+
+    def put_video_features(
+        self, video_id, transcript_hash, settings_hash, top_words, top_grams
+    ):
+        with self.conn:
+            # One row per video, features for an older transcript or settings are replaced
+            self.cur.execute(
+                put_video_features_query,
+                (
+                    video_id,
+                    transcript_hash,
+                    settings_hash,
+                    json.dumps(top_words),
+                    json.dumps(top_grams),
+                ),
+            )
+
+    def get_video_features_batch(self, keys):
+        # keys are (video_id, transcript_hash, settings_hash), returns the
+        # features that are still valid by video_id
+        valid = {key[0]: key[1:] for key in keys}
+        features = {}
+        for chunk in in_chunks(valid):
+            self.cur.execute(
+                f"SELECT video_id, transcript_hash, settings_hash, top_words, top_grams FROM video_features WHERE video_id IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            )
+            for row in self.cur.fetchall():
+                if valid[row[0]] == (row[1], row[2]):
+                    features[row[0]] = (json.loads(row[3]), json.loads(row[4]))
+        return features
+
+    def put_video_features_batch(self, rows):
+        with self.conn:
+            # rows are (video_id, transcript_hash, settings_hash, top_words, top_grams)
+            self.cur.executemany(
+                put_video_features_query,
+                [
+                    (
+                        video_id,
+                        transcript_hash,
+                        settings_hash,
+                        json.dumps(words),
+                        json.dumps(grams),
+                    )
+                    for video_id, transcript_hash, settings_hash, words, grams in rows
+                ],
+            )
+
+    def get_cached_classification(self, cache_key):
+        self.cur.execute(
+            "SELECT categories FROM classification_cache WHERE cache_key = ?",
+            (cache_key,),
+        )
+        row = self.cur.fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put_cached_classification(self, cache_key, categories):
+        with self.conn:
+            self.cur.execute(
+                "INSERT OR REPLACE INTO classification_cache (cache_key, categories) VALUES (?, ?)",
+                (cache_key, json.dumps(categories)),
+            )
+
     def delete_video_categories(self, video_id):
-        self.cur.execute("DELETE FROM video_categories WHERE video_id = ?", (video_id,))
-        self.conn.commit()
+        with self.conn:
+            self.cur.execute(
+                "DELETE FROM video_categories WHERE video_id = ?", (video_id,)
+            )
 
     def get_video_title(self, video_id):
         self.cur.execute("SELECT title FROM videos WHERE video_id = ?", (video_id,))
@@ -401,11 +794,14 @@ class DBHandler:
         return [c[0] for c in results], [c[1] for c in results]
 
     def put_setting(self, name, value):
-        self.cur.execute(
-            "INSERT INTO settings (setting, setting_value) VALUES (?, ?) ON CONFLICT(setting) DO UPDATE SET setting_value = excluded.setting_value;",
-            (name, value),
-        )
-        self.conn.commit()
+        with self.conn:
+            self.cur.execute(
+                "INSERT INTO settings (setting, setting_value) VALUES (?, ?) ON CONFLICT(setting) DO UPDATE SET setting_value = excluded.setting_value;",
+                (name, value),
+            )
+
+        for listener in setting_listeners:
+            listener(name, value)
 
     def get_settings(self):
         self.cur.execute("SELECT setting, setting_value FROM settings")
@@ -0,0 +1,36 @@
+import importlib
+import sys
+import time
+from contextlib import contextmanager
+
+
+class StartupTimer:
+    # Times each step of starting the app, the report is printed once the first
+    # frame is on screen. Module steps include whatever they import that wasn't
+    # already loaded.
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.steps = []
+
+    @contextmanager
+    def step(self, name):
+        modules = len(sys.modules)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append(
+                (name, time.perf_counter() - start, len(sys.modules) - modules)
+            )
+
+    def import_module(self, name):
+        with self.step(f"import {name}"):
+            return importlib.import_module(name)
+
+    def report(self):
+        print(f"Started in {time.perf_counter() - self.start:.2f}s")
+        for name, seconds, modules in self.steps:
+            print(f"  {name:<36} {seconds * 1000:7.1f} ms {modules:5d} modules")
+
+
+startup_timer = StartupTimer()
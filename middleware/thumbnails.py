@@ -0,0 +1,59 @@
+import asyncio
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+THUMBNAIL_CACHE_DIR = "thumbnail_cache"
+
+
+class ThumbnailFetcher:
+    # Downloads thumbnails over one keep-alive session and keeps a copy of each on
+    # disk, named by the hash of its url, so a thumbnail is only downloaded once
+    def __init__(self, workers=4, timeout=15, cache_dir=THUMBNAIL_CACHE_DIR):
+        workers = max(1, workers)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="thumbnail"
+        )
+        self.timeout = timeout
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def cache_path(self, url):
+        return os.path.join(
+            self.cache_dir, hashlib.sha256(url.encode("utf-8")).hexdigest()
+        )
+
+    def load(self, url):
+        path = self.cache_path(url)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                return f.read()
+
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        data = response.content
+
+        # Write to a temp file first so a crash never leaves half an image behind
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        return data
+
+    async def fetch(self, url):
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, self.load, url)
+        except Exception as e:
+            print(e)
+            print(url)
+            return b""
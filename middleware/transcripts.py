@@ -0,0 +1,58 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TranscriptFetcher:
+    # YoutubeLoader is blocking, so every load runs on a small pool of worker
+    # threads and the event loop only ever awaits the result
+    def __init__(self, workers=4, timeout=60, retries=3, backoff=1.0):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(1, workers), thread_name_prefix="transcript"
+        )
+        self.timeout = timeout
+        self.retries = max(1, retries)
+        self.backoff = backoff
+
+    def load(self, url):
+        # langchain takes a while to import, it's left until the first transcript
+        from langchain_community.document_loaders import YoutubeLoader
+
+        transcript = YoutubeLoader.from_youtube_url(
+            url,
+            add_video_info=False,
+            language=["en", "en_auto"],
+            translation="en",
+        ).load()
+        if len(transcript) == 0:
+            return ""
+
+        return transcript[0].page_content
+
+    def fetch_blocking(self, url):
+        for attempt in range(self.retries):
+            try:
+                return self.load(url)
+            except Exception as e:
+                print(f"Transcript attempt {attempt + 1} failed for {url}")
+                print(e)
+                if attempt + 1 < self.retries:
+                    time.sleep(self.backoff * 2**attempt)
+        return None
+
+    async def fetch(self, url):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries):
+            try:
+                # A timed out load keeps its worker thread until YoutubeLoader
+                # gives up, but we stop waiting on it
+                return await asyncio.wait_for(
+                    loop.run_in_executor(self.executor, self.load, url),
+                    self.timeout,
+                )
+            except Exception as e:
+                print(f"Transcript attempt {attempt + 1} failed for {url}")
+                print(repr(e))
+                if attempt + 1 < self.retries:
+                    await asyncio.sleep(self.backoff * 2**attempt)
+        return None
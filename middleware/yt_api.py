@@ -1,32 +1,93 @@
+import asyncio
 import json
-from googleapiclient.discovery import build
 import html
-from langchain_community.document_loaders import YoutubeLoader
-from playwright.async_api import async_playwright
-from bs4 import BeautifulSoup
+import threading
 
-from middleware.sqlite_handler import DBHandler
+from middleware.async_db import async_db_handler
+from middleware.settings import app_settings
+from middleware.thumbnails import ThumbnailFetcher
+from middleware.transcripts import TranscriptFetcher
+from middleware.yt_listing import YT_API_BASE, YT_WEB_BASE, ChannelLister
 
+# Most ids the YouTube Data API accepts in a single videos.list call
+VIDEOS_LIST_MAX_IDS = 50
 
-class YoutubeAPI:
-    def __init__(self):
-        db_handler = DBHandler()
-        self.API_KEY = db_handler.get_settings()["yt_api_key"]
 
-        self.youtube = build("youtube", "v3", developerKey=self.API_KEY)
+class YoutubeAPI:
+    # The base urls are only changed to list channels from a local server
+    def __init__(self, api_base=YT_API_BASE, web_base=YT_WEB_BASE):
+        self.API_KEY = app_settings["yt_api_key"]
+
+        # The API client and the headless browser are slow to set up and only
+        # needed once feeds are refreshed, so both are created on first use
+        self._youtube = None
+        self.youtube_lock = threading.Lock()
+        self.lister = ChannelLister(self.API_KEY, api_base, web_base)
+        self.transcripts = TranscriptFetcher(
+            workers=app_settings["yt_transcript_workers"],
+            timeout=app_settings["yt_transcript_timeout"],
+            retries=app_settings["yt_transcript_retries"],
+        )
+        self.thumbnails = ThumbnailFetcher(
+            workers=app_settings["yt_thumbnail_workers"],
+            timeout=app_settings["yt_thumbnail_timeout"],
+        )
 
-        self.pm = async_playwright()
         self.p = None
         self.browser = None
         self.browser_context = None
 
+    @property
+    def youtube(self):
+        # Details are fetched from worker threads, only one of them builds it
+        with self.youtube_lock:
+            if self._youtube is None:
+                from googleapiclient.discovery import build
+
+                self._youtube = build("youtube", "v3", developerKey=self.API_KEY)
+        return self._youtube
+
     async def get_recent_videos(self, username):
+        backend = app_settings["yt_listing_backend"]
+        if backend in ["feed", "api"]:
+            try:
+                video_ids = await self.list_recent_videos(username, backend)
+                if video_ids:
+                    return video_ids
+                print(f"No uploads listed for {username}, falling back to scraping")
+            except Exception as e:
+                print(
+                    f"Listing {username} with {backend} failed, falling back to scraping"
+                )
+                print(e)
+
+        return await self.scrape_recent_videos(username)
+
+    async def list_recent_videos(self, username, backend):
+        # The channel id and uploads playlist never change, only look them up once
+        db_handler = async_db_handler()
+        channel = await db_handler.get_feed_channel(username)
+        if channel is None:
+            print(f"Resolving channel for {username}")
+            channel = await asyncio.to_thread(self.lister.resolve_channel, username)
+            if channel is None:
+                return []
+            await db_handler.put_feed_channel(username, *channel)
+
+        channel_id, uploads_playlist = channel
+        if backend == "api":
+            return await asyncio.to_thread(self.lister.list_playlist, uploads_playlist)
+        return await asyncio.to_thread(self.lister.list_feed, channel_id)
+
+    async def scrape_recent_videos(self, username):
         # Set up the URL to the channels video page
         url = f"https://www.youtube.com/@{username}/videos"
 
         if self.browser_context is None:
             print("Creating reusable headless browser")
-            self.p = await self.pm.start()
+            from playwright.async_api import async_playwright
+
+            self.p = await async_playwright().start()
             self.browser = await self.p.chromium.launch(headless=True)
             print("Setting up browser context")
             self.browser_context = await self.browser.new_context(
@@ -49,6 +110,8 @@ class YoutubeAPI:
         rendered_html = await page.content()
 
         # Parse the rendered HTML to find all the video IDs to return them
+        from bs4 import BeautifulSoup
+
         soup = BeautifulSoup(rendered_html, "html.parser")
 
         await page.close()
@@ -65,75 +128,84 @@ class YoutubeAPI:
         return video_ids
 
     def get_transcript(self, url):
-        # Max of 3 retries to get transcript
-        for _ in range(3):
+        return self.transcripts.fetch_blocking(url)
+
+    async def get_transcript_async(self, url):
+        return await self.transcripts.fetch(url)
+
+    async def get_thumbnail(self, url):
+        return await self.thumbnails.fetch(url)
+
+    def get_video_details(self, video_id, include_transcript=True):
+        return self.get_video_details_batch([video_id], include_transcript).get(
+            video_id
+        )
+
+    def get_video_details_batch(self, video_ids, include_transcript=True):
+        # videos.list accepts up to 50 ids per call and costs the same single
+        # quota unit as looking up one id, so always ask for as many as we can
+        video_details = {}
+        for i in range(0, len(video_ids), VIDEOS_LIST_MAX_IDS):
+            chunk = video_ids[i : i + VIDEOS_LIST_MAX_IDS]
+            request = self.youtube.videos().list(
+                part="snippet,contentDetails",
+                id=",".join(chunk),
+            )
             try:
-                transcript = YoutubeLoader.from_youtube_url(
-                    url,
-                    add_video_info=False,
-                    language=["en", "en_auto"],
-                    translation="en",
-                ).load()
-                if len(transcript) == 0:
-                    return ""
-
-                ft = transcript[0].page_content
-                if len(ft) == 0:
-                    return ""
-
-                return ft
-            except:
+                response = request.execute()
+            except Exception as e:
+                print("Exception retrieving video details")
+                print(e)
+                print(chunk)
                 continue
 
-    def get_video_details(self, video_id):
-        request = self.youtube.videos().list(part="snippet,contentDetails", id=video_id)
-        response = request.execute()
+            for item in response.get("items", []):
+                vid_data = self.parse_video_item(item, include_transcript)
+                if vid_data is not None:
+                    video_details[vid_data["id"]] = vid_data
 
-        if len(response["items"]) == 0:
-            print("Error: No video data available!!")
-            return None
+            for video_id in chunk:
+                if video_id not in video_details:
+                    print(f"Error: No video data available for {video_id}!!")
 
-        if len(response["items"]) > 1:
-            print(
-                "Error: Too much video data returned? How is there more than one video with the same id?!?"
-            )
+        return video_details
+
+    def parse_video_item(self, item, include_transcript=True):
+        if item["kind"] != "youtube#video":
             return None
 
-        vid_data = None
         try:
-            for item in response["items"]:
-                if item["kind"] == "youtube#video":
-                    video_id = item["id"]
-                    duration = item["contentDetails"]["duration"]
-
-                    # # Try and filter out any shorts (they can be up to 3 minutes long)
-                    # if isodate.parse_duration(duration).seconds < 180:
-                    #     print("Video too short, returning None")
-                    #     return None
-
-                    video_title = html.unescape(item["snippet"]["title"])
-                    video_url = f"https://www.youtube.com/watch?v={video_id}"
-                    video_thumbnail = item["snippet"]["thumbnails"]["medium"]["url"]
-                    video_upload_date = item["snippet"]["publishedAt"]
-                    video_tags = item["snippet"].get("tags", [])
-                    video_description = html.unescape(item["snippet"]["description"])
-
-                    vid_data = {
-                        "id": video_id,
-                        "title": video_title,
-                        "url": video_url,
-                        "thumbnail": video_thumbnail,
-                        "upload_date": video_upload_date,
-                        "tags": json.dumps(video_tags),
-                        "description": video_description,
-                        "transcript": self.get_transcript(video_url),
-                    }
-
-            return vid_data
+            video_id = item["id"]
+            duration = item["contentDetails"]["duration"]
+
+            # # Try and filter out any shorts (they can be up to 3 minutes long)
+            # if isodate.parse_duration(duration).seconds < 180:
+            #     print("Video too short, returning None")
+            #     return None
+
+            video_title = html.unescape(item["snippet"]["title"])
+            video_url = f"https://www.youtube.com/watch?v={video_id}"
+            video_thumbnail = item["snippet"]["thumbnails"]["medium"]["url"]
+            video_upload_date = item["snippet"]["publishedAt"]
+            video_tags = item["snippet"].get("tags", [])
+            video_description = html.unescape(item["snippet"]["description"])
+
+            return {
+                "id": video_id,
+                "title": video_title,
+                "url": video_url,
+                "thumbnail": video_thumbnail,
+                "upload_date": video_upload_date,
+                "tags": json.dumps(video_tags),
+                "description": video_description,
+                "transcript": (
+                    self.get_transcript(video_url) if include_transcript else None
+                ),
+            }
         except Exception as e:
             print("Exception retrieving video details")
             print(e)
-            print(video_id)
-            print(response)
+            print(item)
             print()
             print()
+            return None
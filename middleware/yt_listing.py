@@ -0,0 +1,78 @@
+import xml.etree.ElementTree as ET
+
+import requests
+
+YT_API_BASE = "https://www.googleapis.com/youtube/v3"
+YT_WEB_BASE = "https://www.youtube.com"
+
+FEED_NAMESPACES = {
+    "atom": "http://www.w3.org/2005/Atom",
+    "yt": "http://www.youtube.com/xml/schemas/2015",
+}
+
+
+class ChannelLister:
+    # Lists a channel's uploads with plain HTTP requests instead of rendering the
+    # channel page in a browser. Both base urls can be pointed at a local server.
+    def __init__(
+        self,
+        api_key,
+        api_base=YT_API_BASE,
+        web_base=YT_WEB_BASE,
+        timeout=15,
+    ):
+        self.api_key = api_key
+        self.api_base = api_base.rstrip("/")
+        self.web_base = web_base.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def api_get(self, endpoint, **params):
+        params["key"] = self.api_key
+        response = self.session.get(
+            f"{self.api_base}/{endpoint}", params=params, timeout=self.timeout
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def resolve_channel(self, username):
+        # Feeds are stored by their @handle, older channels may only have a
+        # legacy username so try that second
+        for lookup in [{"forHandle": f"@{username}"}, {"forUsername": username}]:
+            data = self.api_get("channels", part="contentDetails", **lookup)
+            for item in data.get("items", []):
+                uploads = item["contentDetails"]["relatedPlaylists"]["uploads"]
+                return item["id"], uploads
+
+        return None
+
+    def list_playlist(self, playlist_id, max_results=50):
+        data = self.api_get(
+            "playlistItems",
+            part="snippet",
+            playlistId=playlist_id,
+            maxResults=max_results,
+        )
+
+        videos = []
+        for item in data.get("items", []):
+            snippet = item["snippet"]
+            videos.append((snippet["resourceId"]["videoId"], snippet["title"]))
+        return videos
+
+    def list_feed(self, channel_id):
+        response = self.session.get(
+            f"{self.web_base}/feeds/videos.xml",
+            params={"channel_id": channel_id},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+
+        root = ET.fromstring(response.content)
+        videos = []
+        for entry in root.findall("atom:entry", FEED_NAMESPACES):
+            video_id = entry.findtext("yt:videoId", namespaces=FEED_NAMESPACES)
+            title = entry.findtext("atom:title", namespaces=FEED_NAMESPACES)
+            if video_id:
+                videos.append((video_id, title or ""))
+        return videos
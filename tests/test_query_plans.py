@@ -0,0 +1,130 @@
+import sqlite3
+
+import pytest
+
+from middleware import sqlite_handler
+from middleware.db_connections import ConnectionManager
+
+# The schema as it was before migrations existed, user_version 0
+BASELINE_SCHEMA = [
+    "CREATE TABLE settings (setting TEXT PRIMARY KEY, setting_value ANY NOT NULL)",
+    "CREATE TABLE feeds (username TEXT PRIMARY KEY, display_name TEXT)",
+    "CREATE TABLE categories (llm_category TEXT PRIMARY KEY, display_category TEXT NOT NULL UNIQUE)",
+    "CREATE TABLE video_categories (video_id TEXT, llm_category TEXT, FOREIGN KEY (video_id) REFERENCES videos(video_id), FOREIGN KEY (llm_category) REFERENCES categories(llm_category))",
+    "CREATE TABLE videos (video_id TEXT PRIMARY KEY NOT NULL UNIQUE, username TEXT, url TEXT NOT NULL, title TEXT NOT NULL, upload_date DATE, thumbnail BLOB, tags TEXT, description TEXT, transcript TEXT, FOREIGN KEY (username) REFERENCES feeds(username) ON DELETE CASCADE)",
+]
+CATEGORIES = ["Educational", "Entertainment", "Gaming", "Cooking", "Music", "Science"]
+
+
+@pytest.fixture
+def baseline_db(tmp_path):
+    path = str(tmp_path / "data.db3")
+    conn = sqlite3.connect(path)
+    for query in BASELINE_SCHEMA:
+        conn.execute(query)
+    for username in ["a", "b", "c"]:
+        conn.execute("INSERT INTO feeds VALUES (?, ?)", (username, username.upper()))
+    for category in CATEGORIES:
+        conn.execute("INSERT INTO categories VALUES (?, ?)", (category, category))
+    for i in range(600):
+        video_id = f"v{i:04}"
+        conn.execute(
+            "INSERT INTO videos VALUES (?, ?, 'url', 'title', ?, x'00', '[]', '', '')",
+            (video_id, "abc"[i % 3], f"2024-{i % 12 + 1:02}-{i % 28 + 1:02}"),
+        )
+        for category in [CATEGORIES[i % 2], CATEGORIES[2 + i % 4]]:
+            # Older versions could assign the same category twice
+            for _ in range(2):
+                conn.execute(
+                    "INSERT INTO video_categories VALUES (?, ?)", (video_id, category)
+                )
+    conn.commit()
+    return path, conn
+
+
+def migrate(path, monkeypatch):
+    # Returns a fresh connection, plans are read after the migration
+    monkeypatch.setattr(sqlite_handler, "connections", ConnectionManager(path))
+    sqlite_handler.DBHandler()
+    return sqlite3.connect(path)
+
+
+def plan(conn, query, params=()):
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params)]
+
+
+def grid_plan(conn, feed_filters=(), category_filters=(), after=None):
+    db_handler = sqlite_handler.DBHandler.__new__(sqlite_handler.DBHandler)
+    query, params = db_handler.video_grid_query_construct(
+        list(feed_filters), list(category_filters), after, 50
+    )
+    return plan(conn, query, params)
+
+
+def test_baseline_grid_scans_tables(baseline_db):
+    _, conn = baseline_db
+    steps = grid_plan(conn)
+    assert "SCAN vc" in steps
+    assert "USE TEMP B-TREE FOR ORDER BY" in steps
+    assert not any("videos_upload_date_idx" in step for step in steps)
+
+
+def test_migration_reaches_latest_version(baseline_db, monkeypatch):
+    path, _ = baseline_db
+    conn = migrate(path, monkeypatch)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    db_handler = sqlite_handler.DBHandler.__new__(sqlite_handler.DBHandler)
+    assert version == len(db_handler.migrations())
+    # Duplicate assignments are dropped so the unique index could be built
+    assert conn.execute("SELECT COUNT(*) FROM video_categories").fetchone()[0] == 1200
+
+
+def test_grid_walks_upload_date_index(baseline_db, monkeypatch):
+    path, _ = baseline_db
+    conn = migrate(path, monkeypatch)
+
+    steps = grid_plan(conn)
+    assert "SCAN v USING INDEX videos_upload_date_idx" in steps
+    assert "USE TEMP B-TREE FOR ORDER BY" not in steps
+
+    steps = grid_plan(conn, after=("2024-06-01", "v0100"))
+    assert any(
+        step.startswith("SEARCH v USING INDEX videos_upload_date_idx") for step in steps
+    )
+
+
+def test_grid_category_lookups_are_covered(baseline_db, monkeypatch):
+    path, _ = baseline_db
+    conn = migrate(path, monkeypatch)
+
+    for steps in [
+        grid_plan(conn),
+        grid_plan(conn, category_filters=["Educational", "Gaming"]),
+        grid_plan(conn, feed_filters=["a"]),
+    ]:
+        video_category_steps = [step for step in steps if " vc" in step]
+        assert video_category_steps
+        for step in video_category_steps:
+            assert "USING COVERING INDEX video_categories_video_idx" in step
+
+
+def test_category_and_video_lookups_use_indexes(baseline_db, monkeypatch):
+    path, _ = baseline_db
+    conn = migrate(path, monkeypatch)
+
+    steps = plan(
+        conn,
+        "SELECT video_id FROM video_categories WHERE llm_category = ?",
+        ("Cooking",),
+    )
+    assert steps == [
+        "SEARCH video_categories USING COVERING INDEX video_categories_category_idx (llm_category=?)"
+    ]
+    steps = plan(
+        conn,
+        "SELECT llm_category FROM video_categories WHERE video_id = ?",
+        ("v0001",),
+    )
+    assert steps == [
+        "SEARCH video_categories USING COVERING INDEX video_categories_video_idx (video_id=?)"
+    ]
@@ -0,0 +1,75 @@
+import random
+
+import pytest
+from nltk.tokenize import word_tokenize
+
+from middleware.features import TAIL_CHARS, regex_word_tokenize
+
+# Pieces that exercise each of word_tokenize's rules
+WORDS = [
+    "hello", "world", "don't", "can't", "it's", "i'm", "we'll", "they're",
+    "you've", "'tis", "'twas", "cannot", "gonna", "wanna", "gimme", "lemme",
+    "gotta", "more'n", "d'ye", "rock'n'roll", "o'clock", "'hello'", '"quoted"',
+    "(paren)", "[br]", "{x}", "<y>", "3,000", "3:45", "a,b", "a:b", "e.g.",
+    "u.s.", "3.5", "end.", "wait...", "what?!", "wow!", "a--b", "well-known",
+    "x/y", "at&t", "#tag", "@user", "$5", "50%", "a;b", "*star*", "don’t",
+    "“smart”", "‘single’", "«guil»", "``tick''", "x''y", "''s", ",,5", "wanna.",
+    "gonna.", "cannot,", "naïve", "can't.", "it's)", "'s", "'", '"', "''",
+    "...", "--", "—dash—", "a–b", ".", ",", ":", ")", "'abc", "x'", "x'?",
+    "word'*", "2.", 'hi."', 'hi. "', "hi.)", "x.'abc", "',abc", "..'abc",
+    "snake_case",
+]  # fmt: skip
+SEPARATORS = [" ", " ", " ", "  ", "\n", "\t", " \n "]
+
+
+def nltk_words(text):
+    return [w for w in word_tokenize(text, preserve_line=True) if w.isalnum()]
+
+
+def regex_words(text):
+    # FeatureExtractor only keeps alphanumeric tokens of lowercased text
+    return [w for w in regex_word_tokenize(text) if w.isalnum()]
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "i can't believe it's not butter, they're gonna love it.",
+        "'tis the season, 'twas the night. cannot wait, gimme more'n that",
+        'he said "hello" and (quietly) left... wait, what?! ok.',
+        "“smart quotes” and ‘single ones’ don’t split the same",
+        "numbers like 3,000 and 3:45 stay whole, a,b and a:b don't",
+        "the end.",
+        'the end."',
+        'the end. ")',
+        "",
+    ],
+)
+def test_matches_nltk(text):
+    assert regex_words(text) == nltk_words(text)
+
+
+@pytest.mark.parametrize("ending", ["end.", 'end. ")', 'hi."', "x", "wait...", ""])
+def test_matches_nltk_past_tail(ending):
+    # Only the last TAIL_CHARS get the final period and starting quote rules
+    rng = random.Random(ending)
+    text = " ".join(rng.choice(WORDS) for _ in range(TAIL_CHARS))
+    text += " " + ending
+    assert len(text) > 2 * TAIL_CHARS
+    assert regex_words(text) == nltk_words(text)
+
+
+def test_matches_nltk_on_random_text():
+    rng = random.Random(15)
+    for _ in range(5000):
+        if rng.random() < 0.3:
+            # Pieces glued together without spaces
+            text = "".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+        else:
+            text = "".join(
+                rng.choice(WORDS) + rng.choice(SEPARATORS)
+                for _ in range(rng.randint(1, 12))
+            )
+            if rng.random() < 0.5:
+                text = text.rstrip()
+        assert regex_words(text) == nltk_words(text), text
@@ -0,0 +1,29 @@
+import sqlite3
+
+import pytest
+
+from middleware import sqlite_handler
+from middleware.db_connections import ConnectionManager
+
+
+@pytest.fixture
+def connections(tmp_path, monkeypatch):
+    manager = ConnectionManager(str(tmp_path / "data.db3"), busy_timeout=0.1)
+    monkeypatch.setattr(sqlite_handler, "connections", manager)
+    return manager
+
+
+def test_failed_write_rolls_back(connections):
+    db_handler = sqlite_handler.DBHandler()
+    db_handler.add_category("Gaming", "Gaming")
+    with pytest.raises(sqlite3.IntegrityError):
+        db_handler.add_category("Gaming", "Gaming")
+    with pytest.raises(sqlite3.IntegrityError):
+        db_handler.add_feed("a", "A")
+        db_handler.add_feed("a", "A")
+
+    # The shared connection is left without an open transaction, so the
+    # background writer isn't locked out
+    assert not db_handler.conn.in_transaction
+    sqlite_handler.DBHandler(background=True).truncate_video_categories()
+    assert db_handler.get_llm_categories_list() == ["Gaming"]
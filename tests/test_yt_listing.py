@@ -0,0 +1,125 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from middleware import async_db, sqlite_handler
+from middleware.db_connections import ConnectionManager
+from middleware.yt_api import YoutubeAPI
+
+CHANNEL_ID = "UCabc"
+UPLOADS = "UUabc"
+FEED = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns:yt="http://www.youtube.com/xml/schemas/2015" xmlns="http://www.w3.org/2005/Atom">
+  <entry><yt:videoId>feed1</yt:videoId><title>First</title></entry>
+  <entry><yt:videoId>feed2</yt:videoId><title>Second</title></entry>
+</feed>
+"""
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Answers the few YouTube Data API and feed requests ChannelLister makes
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self.requests.append((url.path, params))
+
+        if url.path == "/youtube/v3/channels":
+            items = []
+            # Only the legacy username lookup knows the channel
+            if params.get("forUsername") == "legacy":
+                items = [
+                    {
+                        "id": CHANNEL_ID,
+                        "contentDetails": {"relatedPlaylists": {"uploads": UPLOADS}},
+                    }
+                ]
+            self.reply("application/json", json.dumps({"items": items}))
+        elif url.path == "/youtube/v3/playlistItems":
+            items = [
+                {"snippet": {"resourceId": {"videoId": f"api{i}"}, "title": f"T{i}"}}
+                for i in range(3)
+            ]
+            self.reply("application/json", json.dumps({"items": items}))
+        elif url.path == "/feeds/videos.xml" and params["channel_id"] == CHANNEL_ID:
+            self.reply("application/atom+xml", FEED)
+        else:
+            self.send_error(404)
+
+    def reply(self, content_type, body):
+        data = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def stub_server():
+    StubHandler.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    yield base
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def yt_api(stub_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        sqlite_handler,
+        "connections",
+        ConnectionManager(str(tmp_path / "data.db3")),
+    )
+    # Channel lookups go through the shared async handler, made on first use
+    monkeypatch.setattr(async_db, "_async_db_handler", None)
+    return YoutubeAPI(api_base=f"{stub_server}/youtube/v3", web_base=stub_server)
+
+
+def test_resolve_channel_falls_back_to_username(yt_api):
+    assert yt_api.lister.resolve_channel("legacy") == (CHANNEL_ID, UPLOADS)
+    lookups = [params for path, params in StubHandler.requests]
+    assert lookups[0]["forHandle"] == "@legacy"
+    assert lookups[1]["forUsername"] == "legacy"
+
+
+def test_resolve_unknown_channel(yt_api):
+    assert yt_api.lister.resolve_channel("nobody") is None
+
+
+def test_list_feed(yt_api):
+    assert yt_api.lister.list_feed(CHANNEL_ID) == [
+        ("feed1", "First"),
+        ("feed2", "Second"),
+    ]
+
+
+def test_list_playlist(yt_api):
+    assert yt_api.lister.list_playlist(UPLOADS) == [
+        ("api0", "T0"),
+        ("api1", "T1"),
+        ("api2", "T2"),
+    ]
+    _, params = StubHandler.requests[0]
+    assert params["playlistId"] == UPLOADS
+    assert params["key"] == yt_api.API_KEY
+
+
+def test_channel_is_only_resolved_once(yt_api):
+    for _ in range(2):
+        videos = asyncio.run(yt_api.list_recent_videos("legacy", "feed"))
+        assert [video_id for video_id, _ in videos] == ["feed1", "feed2"]
+    paths = [path for path, _ in StubHandler.requests]
+    assert paths.count("/youtube/v3/channels") == 2
+    assert paths.count("/feeds/videos.xml") == 2
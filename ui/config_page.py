@@ -1,9 +1,8 @@
 import random
 
 import flet as ft
-from rich import print_json
 
-from middleware.sqlite_handler import DBHandler
+from middleware.settings import app_settings
 
 LABEL_WIDTH = 165
 
@@ -31,13 +30,12 @@ class ConfigPage(ft.AlertDialog):
     def __init__(self, width, height):
         super().__init__()
 
-        self.db_handler = DBHandler()
-        self.settings = self.db_handler.get_settings()
+        self.settings = app_settings.raw()
 
         self.config_controls = []
         put_last = []
         for k, v in sorted(self.settings.items()):
-            if "prompt" in k:
+            if k.endswith("_prompt"):
                 put_last.append((k, v, 12))
             else:
                 self.config_controls.append(ConfigRow(k, v, 1))
@@ -67,6 +65,7 @@ class ConfigPage(ft.AlertDialog):
         for setting in self.config_controls:
             key = setting.setting
             value = setting.setting_input.value
-            self.db_handler.put_setting(key, value)
+            if value != self.settings[key]:
+                app_settings.put(key, value)
 
         self.page.close(self)
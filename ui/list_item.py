@@ -1,6 +1,6 @@
 import flet as ft
 
-from middleware.sqlite_handler import DBHandler
+from middleware.settings import app_settings
 
 
 class MyListItem(ft.ListTile):
@@ -42,16 +42,11 @@ class MyListItem(ft.ListTile):
         self.update()
 
     def delete_item(self, _):
-        db_handler = DBHandler()
-        settings = db_handler.get_settings()
-
         def confirm_callback(_):
             self.page.close(dialog)
             self.rm_cb(self.data[0])
 
-        confirm_delete = True if settings["app_confirm_delete"] == "True" else False
-
-        if confirm_delete:
+        if app_settings["app_confirm_delete"]:
             if self.page is None:
                 print("No page attribute present")
                 return
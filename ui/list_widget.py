@@ -1,6 +1,6 @@
 import flet as ft
-from sympy.physics.units import second
 
+from middleware.settings import app_settings
 from middleware.sqlite_handler import DBHandler
 from ui.list_item import MyListItem
 
@@ -16,8 +16,6 @@ class MyListWidget(ft.Container):
     ):
         super().__init__()
 
-        db_handler = DBHandler()
-        self.settings = db_handler.get_settings()
         self.yt_api = yt_api
         self.list_type = list_type
 
@@ -43,7 +41,7 @@ class MyListWidget(ft.Container):
                             on_click=self.show_input_prompt,
                             tooltip=ft.Tooltip(
                                 f"Add new {'Channel' if self.list_type == 'channel' else 'Category'}",
-                                wait_duration=int(self.settings["app_tooltip_time"]),
+                                wait_duration=app_settings["app_tooltip_time"],
                             ),
                         ),
                     ]
@@ -135,7 +133,7 @@ class MyListWidget(ft.Container):
                 tile_type=self.list_type,
                 filter_cb=self.filter_update_callback,
                 rm_cb=self.remove_item,
-                tooltip_time=int(self.settings["app_tooltip_time"]),
+                tooltip_time=app_settings["app_tooltip_time"],
             )
         )
 
@@ -1,16 +1,22 @@
+import asyncio
 import random
-from io import BytesIO
 from time import perf_counter
 
 import flet as ft
-import requests
 
-from middleware.llm_handler import LLMHandler
+from middleware.async_db import async_db_handler
+from middleware.ingest_pipeline import IngestPipeline
+from middleware.llm_handler import LLMHandler, classification_stats, ollama_client
+from middleware.settings import app_settings
 from middleware.sqlite_handler import DBHandler
 from middleware.yt_api import YoutubeAPI
 from ui.config_page import ConfigPage
 from ui.list_widget import MyListWidget
-from ui.video_tile import VideoTile
+from ui.render_cache import tile_render_cache
+from ui.video_grid import VideoGrid
+
+# Videos read from the db and feature extracted together when reprocessing
+REPROCESS_CHUNK = 1000
 
 
 class MainPage(ft.Container):
@@ -28,17 +34,21 @@ class MainPage(ft.Container):
         self.feed_filters = []
         self.category_filters = []
 
+        tile_render_cache.max_bytes = app_settings["app_render_cache_mb"] * 1024 * 1024
+        app_settings.subscribe(self.on_setting_changed)
+
         # Create the UI elements
         self.page = page
 
         self.setup_ui()
 
     def setup_ui(self):
-        #
-        settings = self.db_handler.get_settings()
-
         # Grid where all the video tiles will go
-        self.video_grid = ft.GridView(child_aspect_ratio=0.75, max_extent=300)
+        self.video_grid = VideoGrid(
+            tooltip_time=app_settings["app_tooltip_time"],
+            fetch_page=self.fetch_grid_page,
+            load_thumbnails=self.load_grid_thumbnails,
+        )
 
         # Create the side lists for channels and categories
         self.feeds = MyListWidget(
@@ -63,12 +73,7 @@ class MainPage(ft.Container):
             ]
         )
 
-        for video in self.db_handler.get_video_grid_data(
-            self.feed_filters, self.category_filters
-        ):
-            self.video_grid.controls.append(
-                VideoTile(data=video, tooltip_time=int(settings["app_tooltip_time"]))
-            )
+        self.video_grid.refresh()
 
         self.progress_bar = ft.ProgressBar(
             visible=True,
@@ -116,7 +121,7 @@ class MainPage(ft.Container):
             expand=False,
             tooltip=ft.Tooltip(
                 "Fetch new videos from ALL feeds.",
-                wait_duration=int(settings["app_tooltip_time"]),
+                wait_duration=app_settings["app_tooltip_time"],
             ),
         )
 
@@ -137,7 +142,7 @@ class MainPage(ft.Container):
             expand=False,
             tooltip=ft.Tooltip(
                 "Reprocess categories on ALL videos.",
-                wait_duration=int(settings["app_tooltip_time"]),
+                wait_duration=app_settings["app_tooltip_time"],
             ),
         )
 
@@ -148,7 +153,7 @@ class MainPage(ft.Container):
                     on_click=self.clear_filters,
                     tooltip=ft.Tooltip(
                         "Clear all filters.",
-                        wait_duration=int(settings["app_tooltip_time"]),
+                        wait_duration=app_settings["app_tooltip_time"],
                     ),
                 ),
                 ft.Stack(
@@ -186,7 +191,7 @@ class MainPage(ft.Container):
                     ),
                     tooltip=ft.Tooltip(
                         "Change Settings.",
-                        wait_duration=int(settings["app_tooltip_time"]),
+                        wait_duration=app_settings["app_tooltip_time"],
                     ),
                 ),
             ],
@@ -288,24 +293,26 @@ class MainPage(ft.Container):
         self.proc_update_button.tooltip.message = "Reprocess categories on ALL videos."
         self.update()
 
-    def update_video_grid(self):
-        db = DBHandler()
-
-        all_videos = db.get_video_grid_data(
-            self.feed_filters, self.category_filters, limit=100
-        )
-        settings = db.get_settings()
-
-        new_grid = []
-
-        for video in all_videos:
-            new_grid.append(
-                VideoTile(data=video, tooltip_time=int(settings["app_tooltip_time"]))
+    # The grid is refreshed from the event loop and from Flet's handler threads,
+    # so every fetch borrows its own reader connection
+    def fetch_grid_page(self, after, page_size):
+        with DBHandler.reader() as db_handler:
+            return db_handler.get_video_grid_page(
+                self.feed_filters, self.category_filters, after, page_size
             )
 
-        self.video_grid.controls = new_grid
+    def load_grid_thumbnails(self, video_ids):
+        with DBHandler.reader() as db_handler:
+            return db_handler.get_thumbnails(video_ids)
+
+    def update_video_grid(self, reset=False):
+        self.video_grid.refresh(reset)
         self.video_grid.update()
 
+    async def update_video_grid_async(self, reset=False):
+        # For coroutines, the grid fetch runs on a thread instead of the loop
+        await asyncio.to_thread(self.update_video_grid, reset)
+
     def filter_update(self, data, type, action):
         if action == "added":
             if type == "feed":
@@ -318,7 +325,7 @@ class MainPage(ft.Container):
             else:
                 self.category_filters.remove(data)
 
-        self.update_video_grid()
+        self.update_video_grid(reset=True)
 
     def clear_filters(self, _):
         self.feed_filters.clear()
@@ -332,78 +339,213 @@ class MainPage(ft.Container):
         self.feeds.update()
         self.categories.update()
 
-        self.update_video_grid()
+        self.update_video_grid(reset=True)
 
     async def reprocess_all_categories(self, video_grid, progress_bar, progress_text):
+        # Imported here so numpy isn't loaded at startup
+        from middleware.pre_classifier import guess_categories, train_pre_classifier
+
         start = perf_counter()
         progress_bar.value = None
         progress_bar.color = ft.colors.RED
         progress_bar.update()
 
-        db_handler = DBHandler()
-        print("Clearing video_categories table...")
-        db_handler.truncate_video_categories()
-        settings = db_handler.get_settings()
-
-        video_grid.controls.clear()
-        video_grid.update()
-        for video in db_handler.get_video_grid_data(
-            self.feed_filters, self.category_filters
-        ):
-            video_grid.controls.append(
-                VideoTile(data=video, tooltip_time=int(settings["app_tooltip_time"]))
+        db_handler = async_db_handler()
+        print("Getting list of categories...")
+        current_categories = await db_handler.get_categories_full()
+
+        # Trained on the current assignments before they're cleared
+        pre_classifier = None
+        if app_settings["ollama_pre_classifier"]:
+            print("Training the pre-classifier...")
+            pre_classifier = await asyncio.to_thread(
+                train_pre_classifier,
+                await db_handler.get_labelled_videos(),
+                [c[0] for c in current_categories],
             )
-        video_grid.update()
+            if pre_classifier is None:
+                print("Not enough labelled videos, every video goes to the LLM")
 
-        print("Getting list of videos...")
-        videos = db_handler.get_full_video_data()
-        print("Getting list of categories...")
-        current_categories = db_handler.get_categories_full()
+        print("Clearing video_categories table...")
+        await db_handler.truncate_video_categories()
+
+        await self.update_video_grid_async()
+
+        total = await db_handler.count_videos()
         print("Running categorize_video for each video")
+        prompt_tokens_before = ollama_client().prompt_token_totals()
+        stats_before = classification_stats.snapshot()
         finished = 0
+        # Videos whose prompt inputs haven't changed reuse the last result
+        cache_hits = 0
+        # Videos the pre-classifier was confident enough about to skip the LLM
+        pre_classified = 0
+        llm_handler = self.llm_handler
+        llm_categories = [c[0] for c in current_categories]
+
+        async def prepare_videos(videos):
+            # Features for a chunk of videos, then the pre-classifier's guesses
+            # for the whole chunk. Returns (videos, {video id: categories}).
+            videos = await llm_handler.videos_features(videos, db_handler)
+            if pre_classifier is None:
+                return videos, {}
+            guesses = await asyncio.to_thread(
+                guess_categories,
+                pre_classifier,
+                videos,
+                app_settings["ollama_pre_classifier_threshold"],
+            )
+            # Held to the same rules as the LLM's replies, a guess that doesn't
+            # pass leaves the video to the LLM
+            guesses = {
+                video_id: llm_handler.check_categories(categories, llm_categories)
+                for video_id, categories in guesses.items()
+            }
+            return videos, {
+                video_id: categories
+                for video_id, categories in guesses.items()
+                if categories is not None
+            }
+
+        async def save_guesses(guesses):
+            nonlocal finished, pre_classified
+            await db_handler.bulk_add_video_category(
+                [
+                    (video_id, category)
+                    for video_id, categories in guesses.items()
+                    for category in categories
+                ]
+            )
+            finished += len(guesses)
+            pre_classified += len(guesses)
+            print(f"Finished {finished}/{total}, pre-classified {len(guesses)}")
+            await self.update_video_grid_async()
+            progress_bar.value = finished / total
+            progress_bar.update()
 
-        # Shuffle the videos to give me variety in the output so I can maybe test classification options
-        # easier?
-        random.shuffle(videos)
-        # videos = videos[:limit]
-
-        for video in videos:
-            if self.CANCEL_FLAG:
-                break
-            results = []
-            progress_text.value = f"Classifying {video['title']}"
+        async def classify_videos(videos):
+            nonlocal finished, cache_hits
+            progress_text.value = f"Classifying {videos[0]['title']}"
             progress_text.update()
-            video_categories = await self.llm_handler.categorize_video(
-                video["title"],
-                video["transcript"],
-                [c[0] for c in current_categories],
+            classified = await llm_handler.cached_categorize_videos(
+                videos, llm_categories, db_handler
             )
-            for vc in video_categories:
-                for c in current_categories:
-                    if c[0] == vc:
-                        results.append((video["id"], c[0]))
-            db_handler.bulk_add_video_category(results)
-
-            video_grid.controls.clear()
-            video_grid.update()
-            for video in db_handler.get_video_grid_data(
-                self.feed_filters, self.category_filters
-            ):
-                video_grid.controls.append(
-                    VideoTile(
-                        data=video, tooltip_time=int(settings["app_tooltip_time"])
-                    )
-                )
-            video_grid.update()
 
-            finished += 1
-            print(f"Finished {finished}/{len(videos)}")
-            progress_bar.value = finished / len(videos)
+            missed = False
+            for video in videos:
+                results = []
+                video_categories, cache_hit = classified[video["id"]]
+                for vc in video_categories:
+                    for c in current_categories:
+                        if c[0] == vc:
+                            results.append((video["id"], c[0]))
+                await db_handler.bulk_add_video_category(results)
+
+                finished += 1
+                if cache_hit:
+                    cache_hits += 1
+                missed = missed or not cache_hit
+                print(f"Finished {finished}/{total}")
+
+            # Cache hits are quick, the grid only refreshes every so often for
+            # those
+            if missed or cache_hits % 50 < len(videos):
+                await self.update_video_grid_async()
+            progress_bar.value = finished / total
             progress_bar.update()
 
+        # Several requests are made at once, the shared ollama client limits how
+        # many are in flight. Each request covers up to ollama_batch_size videos.
+        batch_size = app_settings["ollama_batch_size"]
+        queue = asyncio.Queue(maxsize=app_settings["ollama_parallel"] * 2)
+
+        async def worker():
+            while True:
+                videos = await queue.get()
+                try:
+                    # Once cancelled the queued videos are skipped, the ones
+                    # already being classified still finish and get saved
+                    if not self.CANCEL_FLAG:
+                        await classify_videos(videos)
+                except Exception as e:
+                    print(f"Failed to classify {[v['title'] for v in videos]}")
+                    print(e)
+                finally:
+                    queue.task_done()
+
+        workers = [
+            asyncio.create_task(worker())
+            for _ in range(app_settings["ollama_parallel"])
+        ]
+
+        async def queue_videos(prepared):
+            videos, guesses = prepared
+            if self.CANCEL_FLAG:
+                return
+            # Confident guesses are saved straight away, only the rest wait for
+            # the LLM
+            if guesses:
+                await save_guesses(guesses)
+                videos = [video for video in videos if video["id"] not in guesses]
+
+            # Shuffle the videos to give me variety in the output so I can maybe test classification options
+            # easier?
+            random.shuffle(videos)
+
+            for i in range(0, len(videos), batch_size):
+                if self.CANCEL_FLAG:
+                    break
+                await queue.put(videos[i : i + batch_size])
+
+        # Videos are streamed in chunks rather than loaded all at once. The
+        # features for the next chunk are extracted on the process pool and
+        # scored by the pre-classifier while the current one is being classified.
+        extracting = None
+        try:
+            async for videos in db_handler.iter_full_video_data(REPROCESS_CHUNK):
+                next_extracting = asyncio.create_task(prepare_videos(videos))
+                if extracting is not None:
+                    await queue_videos(await extracting)
+                extracting = next_extracting
+
+                if self.CANCEL_FLAG:
+                    break
+            if extracting is not None and not self.CANCEL_FLAG:
+                await queue_videos(await extracting)
+            await queue.join()
+        finally:
+            tasks = [task for task in [extracting, *workers] if task is not None]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        await self.update_video_grid_async()
+
         print("Complete!")
         end = perf_counter()
-        print(f"Took {end - start:.2f} seconds to reprocess {len(videos)} videos")
+        print(f"Took {end - start:.2f} seconds to reprocess {finished} videos")
+        print(f"Pre-classified without the LLM: {pre_classified}")
+        print(
+            f"Classification cache: {cache_hits} hits, {finished - pre_classified - cache_hits} misses"
+        )
+        evaluated, cached, unknown = [
+            after - before
+            for after, before in zip(
+                ollama_client().prompt_token_totals(), prompt_tokens_before
+            )
+        ]
+        print(f"Prompt tokens: {evaluated} evaluated, about {cached} cached")
+        if unknown:
+            print(
+                f"Prompt tokens unknown for {unknown} requests, streamed replies stopped early don't report them"
+            )
+        stats = classification_stats.since(stats_before)
+        print(
+            f"LLM requests: {stats['requests']} | Retries: {stats['retries']} | Parse failures: {stats['parse_failures']} | Made up categories removed: {stats['made_up']}"
+        )
+        if stats["streamed"]:
+            print(
+                f"Streamed: {stats['streamed']} | Stopped early: {stats['stopped_early']} | Avg first token: {stats['first_token_time'] / stats['streamed']:0.2f}s | Avg answer: {stats['answer_time'] / stats['streamed']:0.2f}s"
+            )
 
         progress_bar.value = 0.0
         progress_bar.color = ft.colors.TRANSPARENT
@@ -414,95 +556,38 @@ class MainPage(ft.Container):
         progress_bar.color = ft.colors.YELLOW
         progress_bar.update()
 
-        db_handler = DBHandler()
-        settings = db_handler.get_settings()
-        current_video_ids, current_video_titles = (
-            db_handler.get_current_video_ids_and_titles()
-        )
-        current_categories = db_handler.get_categories_full()
-        channels = db_handler.get_channel_usernames()
-
-        finished = 0
-        for channel in channels:
-            if self.CANCEL_FLAG:
-                break
+        db_handler = async_db_handler()
+        channels = await db_handler.get_channel_usernames()
 
-            progress_text.value = f"Finding video ID's for {channel}"
+        def on_status(text):
+            progress_text.value = text
             progress_text.update()
-            recent_videos = await yt_api.get_recent_videos(channel)
-            for video_id, video_title in recent_videos:
-                if video_id in current_video_ids:
-                    current_title = db_handler.get_video_title(video_id)
-                    if video_title != current_title:
-                        db_handler.update_title(video_id, video_title)
-                        print(
-                            f"{video_id} was renamed: {current_title} -> {video_title}"
-                        )
-                        continue
-                    print(
-                        f"{video_id} is already in database with matching title, skipping."
-                    )
-                    continue
-
-                video = yt_api.get_video_details(video_id)
-
-                if video is None:
-                    continue
-
-                try:
-                    thumbnail_bytes = BytesIO(
-                        requests.get(video["thumbnail"]).content
-                    ).getvalue()
-                except Exception as e:
-                    print(e)
-                    print(video.get("thumbnail", "No Thumbnail URL Available??"))
-                    thumbnail_bytes = b""
-
-                video_categories = await self.llm_handler.categorize_video(
-                    video["title"],
-                    video["transcript"],
-                    [c[0] for c in current_categories],
-                )
 
-                video_category_ids = []
-                for vc in video_categories:
-                    for c in current_categories:
-                        if c[1] == vc:
-                            video_category_ids.append(c[0])
-
-                db_handler.add_video(
-                    video_id,
-                    channel,
-                    video["url"],
-                    video["title"],
-                    video["upload_date"],
-                    thumbnail_bytes,
-                    video["tags"],
-                    video["description"],
-                    video["transcript"],
-                    video_category_ids,
-                )
-                print(f'Added {video["title"]} to db')
-                video_grid.controls.clear()
-                video_grid.update()
-                for v in db_handler.get_video_grid_data(
-                    self.feed_filters, self.category_filters
-                ):
-                    video_grid.controls.append(
-                        VideoTile(
-                            data=v, tooltip_time=int(settings["app_tooltip_time"])
-                        )
-                    )
-                video_grid.update()
-            finished += 1
-            progress_bar.value = finished / len(channels)
+        def on_progress(value):
+            progress_bar.value = value
             progress_bar.update()
+
+        pipeline = IngestPipeline(
+            yt_api,
+            self.llm_handler,
+            db_handler,
+            app_settings,
+            should_cancel=lambda: self.CANCEL_FLAG,
+            on_status=on_status,
+            on_progress=on_progress,
+            on_video_added=self.update_video_grid_async,
+        )
+        await pipeline.run(channels)
         print("Update complete")
 
         progress_bar.value = 0.0
         progress_bar.color = ft.colors.TRANSPARENT
         progress_bar.update()
 
+    def on_setting_changed(self, name, value):
+        if name == "app_render_cache_mb":
+            tile_render_cache.max_bytes = value * 1024 * 1024
+
     def on_resized(self, event: ft.WindowResizeEvent):
         self.left_side.width = 250
         self.left_side.height = event.height
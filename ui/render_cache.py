@@ -0,0 +1,51 @@
+import base64
+from collections import OrderedDict
+from datetime import datetime
+
+
+class TileRenderCache:
+    # Keeps the base64 image and formatted date for each video tile so grid
+    # rebuilds don't re-encode the same thumbnails over and over. Least recently
+    # used entries are dropped once the encoded images go over max_bytes.
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.entries = OrderedDict()
+
+    def missing(self, video_ids):
+        missing = []
+        for video_id in video_ids:
+            if video_id in self.entries:
+                # About to be shown, so keep it away from the eviction end
+                self.entries.move_to_end(video_id)
+            else:
+                missing.append(video_id)
+        return missing
+
+    def render(self, data):
+        entry = self.entries.get(data["id"])
+        if entry is not None:
+            self.entries.move_to_end(data["id"])
+            return entry
+
+        entry = {
+            "image_src": base64.b64encode(data.get("thumbnail") or b"").decode("utf-8"),
+            "upload_date": datetime.fromisoformat(
+                data["upload_date"].replace("Z", "+00:00")
+            ).strftime("%B %d, %Y"),
+        }
+        # Without the image bytes the entry is only a placeholder, don't keep it
+        if data.get("thumbnail") is None:
+            return entry
+
+        self.entries[data["id"]] = entry
+        self.used_bytes += len(entry["image_src"])
+
+        while self.used_bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.used_bytes -= len(evicted["image_src"])
+
+        return entry
+
+
+tile_render_cache = TileRenderCache()
@@ -0,0 +1,92 @@
+import threading
+
+import flet as ft
+
+from ui.render_cache import tile_render_cache
+from ui.video_tile import VideoTile
+
+# How close to the bottom of the grid, in pixels, the next page starts loading
+LOAD_MORE_DISTANCE = 600
+
+
+class VideoGrid(ft.GridView):
+    # Keeps one VideoTile per shown video and reuses it across refreshes. A sync
+    # only creates tiles for new videos, drops the ones that left the result set
+    # and patches changed titles or categories, so an update sends the changes
+    # rather than the whole grid.
+    # Videos are loaded a page at a time, the next page is fetched once the grid
+    # is scrolled close to the bottom. Refreshes and page loads can come from
+    # different threads, they take turns on the lock.
+    def __init__(self, tooltip_time, fetch_page, load_thumbnails, page_size=50):
+        super().__init__(child_aspect_ratio=0.75, max_extent=300)
+        self.tooltip_time = tooltip_time
+        self.fetch_page = fetch_page
+        self.load_thumbnails = load_thumbnails
+        self.page_size = page_size
+        self.tiles = {}
+        self.cursor = None
+        self.lock = threading.Lock()
+
+        self.on_scroll_interval = 100
+        self.on_scroll = self.on_grid_scroll
+
+    def make_tiles(self, videos):
+        new_ids = [video["id"] for video in videos if video["id"] not in self.tiles]
+        # Only load the images for new tiles that haven't been rendered yet
+        thumbnails = self.load_thumbnails(tile_render_cache.missing(new_ids))
+
+        tiles = []
+        for video in videos:
+            tile = self.tiles.get(video["id"])
+            if tile is None:
+                video["thumbnail"] = thumbnails.get(video["id"])
+                tile = VideoTile(data=video, tooltip_time=self.tooltip_time)
+            else:
+                tile.patch(video)
+            tiles.append(tile)
+        return tiles
+
+    def refresh(self, reset=False):
+        # Only the first page is re-queried so a refresh costs the same however
+        # far the grid was scrolled. The tiles loaded past it are kept to hold
+        # the scroll position, unless the result set changed completely (e.g.
+        # new filters) or now fits in that one page.
+        with self.lock:
+            videos, cursor = self.fetch_page(None, self.page_size)
+
+            new_controls = self.make_tiles(videos)
+            if not reset and cursor is not None:
+                first_page = {tile.data["id"] for tile in new_controls}
+                older = [
+                    tile
+                    for tile in self.controls
+                    if tile.data["id"] not in first_page
+                    and (tile.data["upload_date"], tile.data["id"]) < cursor
+                ]
+                if older:
+                    new_controls += older
+                    cursor = self.cursor
+            self.cursor = cursor
+            self.tiles = {tile.data["id"]: tile for tile in new_controls}
+            self.controls = new_controls
+
+    def load_next_page(self):
+        # Scroll events keep coming while a page loads, those are dropped
+        if not self.lock.acquire(blocking=False):
+            return
+
+        try:
+            if self.cursor is None:
+                return
+            videos, self.cursor = self.fetch_page(self.cursor, self.page_size)
+            for tile in self.make_tiles(videos):
+                if tile.data["id"] not in self.tiles:
+                    self.tiles[tile.data["id"]] = tile
+                    self.controls.append(tile)
+            self.update()
+        finally:
+            self.lock.release()
+
+    def on_grid_scroll(self, e: ft.OnScrollEvent):
+        if e.pixels >= e.max_scroll_extent - LOAD_MORE_DISTANCE:
+            self.load_next_page()
@@ -1,10 +1,9 @@
 import flet as ft
-import base64
 import pyperclip
-from datetime import datetime
 
 from middleware.llm_handler import LLMHandler
-from middleware.sqlite_handler import DBHandler
+from middleware.async_db import async_db_handler
+from ui.render_cache import tile_render_cache
 
 
 class VideoTile(ft.Container):
@@ -19,20 +18,26 @@ class VideoTile(ft.Container):
         self.expand_loose = True
         self.text_style = ft.TextStyle(color=ft.colors.ON_SECONDARY_CONTAINER, size=13)
         self.chip_style = ft.TextStyle(color=ft.colors.ON_SECONDARY_CONTAINER, size=12)
+        rendered = tile_render_cache.render(data)
 
         self.category_chips = ft.Row(
             [
-                ft.Chip(
-                    label=ft.Text(category, style=self.chip_style),
-                    disabled_color=ft.colors.PRIMARY_CONTAINER,
-                    padding=0,
-                )
+                self.make_chip(category)
                 for category in sorted(data["categories"], key=lambda x: x.lower())
             ],
             tight=True,
             scroll=ft.ScrollMode.AUTO,
         )
 
+        self.title_text = ft.Text(
+            data["title"] + "\n",
+            style=self.text_style,
+            expand=True,
+            max_lines=2,
+            # max_lines=2,
+            overflow=ft.TextOverflow.ELLIPSIS,
+        )
+
         self.classify_spinner = ft.ProgressRing(
             width=32,
             height=32,
@@ -47,9 +52,7 @@ class VideoTile(ft.Container):
                 ft.Column(
                     [
                         ft.Image(
-                            src_base64=base64.b64encode(data["thumbnail"]).decode(
-                                "utf-8"
-                            ),
+                            src_base64=rendered["image_src"],
                         ),
                         ft.Text(
                             data["display_name"],
@@ -58,21 +61,12 @@ class VideoTile(ft.Container):
                             overflow=ft.TextOverflow.ELLIPSIS,
                         ),
                         ft.Text(
-                            datetime.fromisoformat(
-                                data["upload_date"].replace("Z", "+00:00")
-                            ).strftime("%B %d, %Y"),
+                            rendered["upload_date"],
                             style=self.text_style,
                             max_lines=1,
                             overflow=ft.TextOverflow.ELLIPSIS,
                         ),
-                        ft.Text(
-                            data["title"] + "\n",
-                            style=self.text_style,
-                            expand=True,
-                            max_lines=2,
-                            # max_lines=2,
-                            overflow=ft.TextOverflow.ELLIPSIS,
-                        ),
+                        self.title_text,
                         self.category_chips,
                     ]
                 ),
@@ -128,6 +122,27 @@ class VideoTile(ft.Container):
             ]
         )
 
+    def make_chip(self, category):
+        return ft.Chip(
+            label=ft.Text(category, style=self.chip_style),
+            disabled_color=ft.colors.PRIMARY_CONTAINER,
+            padding=0,
+        )
+
+    def patch(self, data):
+        # Bring an existing tile in line with fresh grid data, only touching the
+        # controls that actually changed so the next update sends a small diff
+        if data["title"] != self.data["title"]:
+            self.data["title"] = data["title"]
+            self.title_text.value = data["title"] + "\n"
+
+        if sorted(data["categories"]) != sorted(self.data["categories"]):
+            self.data["categories"] = data["categories"]
+            self.category_chips.controls = [
+                self.make_chip(category)
+                for category in sorted(data["categories"], key=lambda x: x.lower())
+            ]
+
     async def reclassify_video(self, _):
         # First clear all visible categories for the video
         self.classify_spinner.visible = True
@@ -137,24 +152,27 @@ class VideoTile(ft.Container):
         self.update()
 
         # Drop all the category associations from the database
-        db_handler = DBHandler()
-        db_handler.delete_video_categories(self.data["id"])
+        db_handler = async_db_handler()
+        await db_handler.delete_video_categories(self.data["id"])
 
         # Get the available categories
-        categories = db_handler.get_categories_full()
+        categories = await db_handler.get_categories_full()
         llm_categories = [c[0] for c in categories]
 
         # Call classify
-        transcript = db_handler.get_video_transcript(self.data["id"])
+        transcript = await db_handler.get_video_transcript(self.data["id"])
         llm_handler = LLMHandler()
-        new_categories = await llm_handler.categorize_video(
-            self.data["title"], transcript, llm_categories
+        features = await llm_handler.video_features(
+            self.data["id"], transcript, db_handler
+        )
+        new_categories, _ = await llm_handler.categorize_video(
+            self.data["title"], transcript, llm_categories, features
         )
 
         new_cat_list = [(self.data["id"], c) for c in new_categories]
 
         # Save the new categories
-        db_handler.bulk_add_video_category(
+        await db_handler.bulk_add_video_category(
             new_cat_list,
         )
 
@@ -164,13 +182,8 @@ class VideoTile(ft.Container):
             for c in categories:
                 if c[0] == llm_category:
                     display_category = c[1]
-            self.category_chips.controls.append(
-                ft.Chip(
-                    label=ft.Text(display_category, style=self.chip_style),
-                    disabled_color=ft.colors.PRIMARY_CONTAINER,
-                    padding=0,
-                )
-            )
+            self.data["categories"].append(display_category)
+            self.category_chips.controls.append(self.make_chip(display_category))
 
         # Update UI
         self.classify_spinner.visible = False